@@ -0,0 +1,269 @@
+"""Benchmarks for gpt_ui.
+
+Run `python bench_main.py` from the project directory. The benchmarks run against a throwaway config directory, so
+your own chats and settings are not touched. Results are written as JSON to --output. If --baseline points to the
+results of a previous run, the script fails when a benchmark got slower than --tolerance allows.
+"""
+import argparse
+import atexit
+import contextlib
+import functools
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+project_dir = Path(__file__).parent.absolute()
+
+benchmarks = {}
+
+def benchmark(name):
+    def register(f):
+        benchmarks[name] = f
+        return f
+    return register
+
+def synthetic_chat(n_messages, content_length=200):
+    chat = [{'role': 'system', 'model': 'gpt-4', 'user': 'bench', 'date': '2023-05-13_00-56-13-186209',
+             'content': 'You are a helpful assistant, that answers every question.'}]
+    for i in range(n_messages - 1):
+        role = 'user' if i % 2 == 0 else 'assistant'
+        content = f'Message {i}. ' + ' '.join(f'word{j}' for j in range(content_length // 6))
+        chat.append({'role': role, 'model': 'gpt-4', 'user': 'bench', 'date': '2023-05-13_00-56-13-186209', 'content': content})
+    return chat
+
+def setup_environment(root, n_chats=50):
+    """Create a config directory, chat directory and obsidian vault below root and point gpt_ui at them."""
+    config_dir = root / 'config' / 'gpt-ui'
+    chat_dir = root / 'chats'
+    vault_dir = root / 'vault'
+    for d in [config_dir, chat_dir, vault_dir]:
+        d.mkdir(parents=True, exist_ok=True)
+    with (config_dir / 'config.yaml').open('w') as f:
+        json.dump({'default_model': 'gpt-4', 'user': 'bench', 'speak': False, 'chat_dir': str(chat_dir),
+                   'obsidian_vault_dir': str(vault_dir), 'prompt_postfix': ' '}, f)
+    with (config_dir / 'api_key.yaml').open('w') as f:
+        f.write('api_key: sk-benchmark\n')
+    for i in range(n_chats):
+        with (chat_dir / f'chat_{i}.json').open('w') as f:
+            json.dump(synthetic_chat(20), f, indent=4)
+    os.environ['XDG_CONFIG_HOME'] = str(root / 'config')
+    return chat_dir, vault_dir
+
+def time_gpt(*args, repeat):
+    """Wall time of running the gpt command line in a fresh interpreter."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, str(project_dir / 'gpt_ui.py'), *args], stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+@benchmark('startup --list-chats')
+def bench_startup_list_chats(repeat):
+    return time_gpt('--list-chats', repeat=repeat)
+
+@benchmark('startup --export-chats-to-markdown')
+def bench_startup_export(repeat):
+    return time_gpt('--export-chats-to-markdown', repeat=repeat)
+
+@benchmark('startup interactive')
+def bench_startup_interactive(repeat):
+    # With stdin closed the user prompt and the save name prompt both get EOF, so this measures starting an
+    # interactive session up to the first prompt and exiting again.
+    return time_gpt(repeat=repeat)
+
+def import_gpt_ui():
+    """Import gpt_ui in this process, after setup_environment pointed it at the throwaway config."""
+    sys.argv = ['gpt']
+    import gpt_ui
+    return gpt_ui
+
+def time_function(f, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return times
+
+def streamed_reply(n_tokens, token_length=4):
+    """A long reply as it arrives in chunks from the API: prose, a numbered list and a code block without any
+       sentence breaks, which is the worst case for splitting sentences.
+    """
+    prose = 'This is a sentence, e.g. about Mr. Smith and the year 2023. Is it long enough? Yes!\n'
+    items = ''.join(f'{i}. Item number {i}.\n' for i in range(1, 20))
+    code = '```python\n' + ''.join(f'value_{i} = compute(value_{i - 1}, "argument")  ' for i in range(n_tokens // 4)) + '\n```\n'
+    text = (prose * (n_tokens // 40) + items + code)[:n_tokens * token_length]
+    return [text[i:i + token_length] for i in range(0, len(text), token_length)]
+
+@benchmark('get_first_sentence streaming 5000 tokens')
+def bench_get_first_sentence(repeat):
+    gpt_ui = import_gpt_ui()
+    chunks = streamed_reply(5000)
+    def run():
+        read_buffer = ''
+        for c in chunks:
+            read_buffer += c
+            _, read_buffer = gpt_ui.get_first_sentence(read_buffer)
+    return time_function(run, repeat)
+
+@benchmark('SentenceSegmenter streaming 5000 tokens')
+def bench_sentence_segmenter(repeat):
+    gpt_ui = import_gpt_ui()
+    chunks = streamed_reply(5000)
+    def run():
+        segmenter = gpt_ui.SentenceSegmenter()
+        for c in chunks:
+            segmenter.feed(c)
+        segmenter.flush()
+    return time_function(run, repeat)
+
+# Benchmarks of the chat hot paths on synthetic chats of these sizes
+chat_sizes = [10, 100, 1000, 10000]
+
+# prompt_toolkit keeps writing to the stdout it saw first, so the null device stays open for the whole run
+devnull = open(os.devnull, 'w')
+
+def quiet(f):
+    """Run f without its output."""
+    with contextlib.redirect_stdout(devnull):
+        return f()
+
+def bench_number_of_tokens(repeat, n_messages):
+    gpt_ui = import_gpt_ui()
+    chat = synthetic_chat(n_messages)
+    return time_function(lambda: gpt_ui.number_of_tokens(chat), repeat)
+
+def bench_trim_chat(repeat, n_messages):
+    gpt_ui = import_gpt_ui()
+    chat = synthetic_chat(n_messages)
+    return time_function(lambda: gpt_ui.trim_chat(chat), repeat)
+
+def linked_chat(gpt_ui, n_messages):
+    """A synthetic chat where every tenth message links a file, and every tenth an obsidian note."""
+    chat = synthetic_chat(n_messages)
+    for i in range(1, n_messages, 10):
+        path = gpt_ui.obsidian_vault_dir / 'notes' / f'note_{i}.md'
+        path.parent.mkdir(exist_ok=True)
+        path.write_text(f'Note {i}\n' * 50)
+        chat[i]['content'] += f' :obsidian:note_{i}:'
+        if i + 5 < n_messages:
+            chat[i + 5]['content'] += f' :file:{path}:'
+    return chat
+
+def bench_explode_chat_cold(repeat, n_messages):
+    gpt_ui = import_gpt_ui()
+    chat = linked_chat(gpt_ui, n_messages)
+    return time_function(lambda: gpt_ui.ChatExploder().explode(chat), repeat)
+
+def bench_explode_chat_warm(repeat, n_messages):
+    gpt_ui = import_gpt_ui()
+    chat = linked_chat(gpt_ui, n_messages)
+    gpt_ui.explode_chat(chat)
+    return time_function(lambda: gpt_ui.explode_chat(chat), repeat)
+
+def bench_backup_chat(repeat, n_messages):
+    gpt_ui = import_gpt_ui()
+    chat = synthetic_chat(n_messages)
+    gpt_ui.backup_chat(chat)
+    def run():
+        chat.append(dict(chat[-1]))
+        gpt_ui.backup_chat(chat)
+    return time_function(run, repeat)
+
+def bench_chat_to_markdown(repeat, n_messages):
+    gpt_ui = import_gpt_ui()
+    chat = synthetic_chat(n_messages)
+    return time_function(lambda: gpt_ui.chat_to_markdown(chat), repeat)
+
+def bench_edit_chat(repeat, n_messages):
+    gpt_ui = import_gpt_ui()
+    chat = synthetic_chat(n_messages)
+    # 'true' leaves the file as it is, so this measures writing and parsing the chat
+    return time_function(lambda: quiet(lambda: gpt_ui.edit_chat(chat, 'true')), repeat)
+
+def bench_open_chat(repeat, n_messages):
+    gpt_ui = import_gpt_ui()
+    path = gpt_ui.chat_dir / f'open_{n_messages}.json'
+    gpt_ui.write_chat([gpt_ui.Message(m) for m in synthetic_chat(n_messages)], path)
+    # Loading and printing a chat is what happens before the first prompt of --load-chat
+    times = time_function(lambda: quiet(lambda: gpt_ui.print_chat(gpt_ui.load_chat(path))), repeat)
+    # The rest of the chat is read in the background, which has to finish before the chat directory is removed
+    for thread in threading.enumerate():
+        if thread.name == 'chat prefetch':
+            thread.join()
+    return times
+
+for n in chat_sizes:
+    benchmark(f'number_of_tokens {n} messages')(functools.partial(bench_number_of_tokens, n_messages=n))
+    benchmark(f'trim_chat {n} messages')(functools.partial(bench_trim_chat, n_messages=n))
+    benchmark(f'explode_chat cold {n} messages')(functools.partial(bench_explode_chat_cold, n_messages=n))
+    benchmark(f'explode_chat warm {n} messages')(functools.partial(bench_explode_chat_warm, n_messages=n))
+    benchmark(f'backup_chat {n} messages')(functools.partial(bench_backup_chat, n_messages=n))
+    benchmark(f'chat_to_markdown {n} messages')(functools.partial(bench_chat_to_markdown, n_messages=n))
+    benchmark(f'open_chat {n} messages')(functools.partial(bench_open_chat, n_messages=n))
+    if n <= 1000:
+        # edit_chat prints the whole chat afterwards, which takes about a minute at 10000 messages
+        benchmark(f'edit_chat {n} messages')(functools.partial(bench_edit_chat, n_messages=n))
+
+@benchmark('list_chats 2000 chats')
+def bench_list_chats(repeat):
+    gpt_ui = import_gpt_ui()
+    for i in range(2000):
+        with (gpt_ui.chat_dir / f'listed_{i}.json').open('w') as f:
+            json.dump(synthetic_chat(20), f)
+    return time_function(lambda: quiet(gpt_ui.list_chats), repeat)
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name in baseline and result['median'] > baseline[name]['median'] * (1 + tolerance):
+            regressions.append(f"{name}: {result['median']:.6f}s vs {baseline[name]['median']:.6f}s")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gpt_ui.')
+    parser.add_argument('-k', '--filter', type=str, default='', help='Only run benchmarks whose name contains this string.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs per benchmark.')
+    parser.add_argument('--output', type=Path, default=Path('bench_results.json'), help='Where to write the results.')
+    parser.add_argument('--baseline', type=Path, help='Results of a previous run to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative slowdown against the baseline.')
+    bench_args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        setup_environment(Path(tmp))
+        results = {}
+        try:
+            for name, f in benchmarks.items():
+                if bench_args.filter not in name:
+                    continue
+                times = f(bench_args.repeat)
+                results[name] = {'median': statistics.median(times), 'min': min(times), 'max': max(times), 'runs': len(times)}
+                print(f"{name:60} {results[name]['median'] * 1000:10.3f} ms")
+        finally:
+            if 'gpt_ui' in sys.modules:
+                # Compact the session backup while the throwaway chat directory still exists
+                gpt_ui = sys.modules['gpt_ui']
+                gpt_ui.chat_journal.compact()
+                atexit.unregister(gpt_ui.chat_journal.compact)
+
+    with bench_args.output.open('w') as f:
+        json.dump(results, f, indent=4)
+
+    if bench_args.baseline:
+        with bench_args.baseline.open() as f:
+            regressions = compare(results, json.load(f), bench_args.tolerance)
+        for r in regressions:
+            print(f"Regression: {r}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
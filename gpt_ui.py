@@ -1,35 +1,70 @@
 from glob import glob
 import hashlib
+import importlib
 import itertools
 import math
+import mmap
 import platform
 import re
+import shutil
+import sqlite3
 import subprocess
 from pathlib import Path
 import argparse
+import atexit
+import bisect
+import contextlib
+import functools
 import json
 import textwrap
 import time
 import os
 import datetime
-from copy import deepcopy
+import fcntl
 from typing import List, Optional, Tuple, Union, Any
 import html
-from threading import Thread
+import random
+from threading import Event, Lock, Thread, current_thread
+from concurrent.futures import CancelledError, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from collections import deque
+from collections.abc import MutableMapping, MutableSequence
+import queue
 import sys
-from gsay import speak
 
-import tiktoken
 import yaml
-import openai
-from openai.error import TryAgain
-import prompt_toolkit as pt
-from prompt_toolkit import HTML, PromptSession
-from prompt_toolkit.history import FileHistory
-from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
-from prompt_toolkit.completion import WordCompleter
 from xdg_base_dirs import xdg_config_home
 
+class LazyModule:
+    """Stand-in for a module that is only imported on first attribute access.
+       Keeps commands like --list-chats from paying for openai, tiktoken and prompt_toolkit.
+    """
+    def __init__(self, name, on_import=None):
+        self._name = name
+        self._on_import = on_import
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            if self._on_import:
+                self._on_import(module)
+            self._module = module
+        return getattr(self._module, attr)
+
+def _setup_openai(module):
+    module.api_key = yaml.load((config_dir / 'api_key.yaml').open(), yaml.FullLoader).get('api_key')
+    if config.get('api_base'):
+        module.api_base = config['api_base']
+    module.requestssession = make_requests_session()
+
+openai = LazyModule('openai', on_import=_setup_openai)
+requests = LazyModule('requests')
+tiktoken = LazyModule('tiktoken')
+pt = LazyModule('prompt_toolkit')
+# Only needed with --profile-phase
+cProfile = LazyModule('cProfile')
+pstats = LazyModule('pstats')
+
 # Basic helper functions
 def timestamp():
     return datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')
@@ -53,7 +88,6 @@ config = yaml.load(config_file.open(), yaml.FullLoader)
 # Load local config file and overwrite default config
 if config_file_local.exists():
     config.update(yaml.load(config_file_local.open(), yaml.FullLoader))
-openai.api_key = yaml.load((config_dir / 'api_key.yaml').open(), yaml.FullLoader).get('api_key')
 
 model = config['default_model']
 user = config['user']
@@ -71,6 +105,7 @@ else:
     chat_dir.mkdir(exist_ok=True)
 
 chat_backup_file = chat_dir / f".backup_{timestamp()}.json"
+chat_catalog_file = chat_dir / ".catalog.sqlite"
 
 prompt_history_dir = project_dir / "prompt_history"
 prompt_history_dir.mkdir(exist_ok=True)
@@ -88,7 +123,9 @@ obsidian_vault_dir = Path(config['obsidian_vault_dir']).expanduser()
 if not obsidian_vault_dir.exists():
     raise FileNotFoundError(f"Obsidian vault directory {obsidian_vault_dir} does not exist.")
 
-enc = tiktoken.encoding_for_model(model)
+# Tokenizers are loaded on first use, one per encoding listed in models_metadata.yaml
+tokenizers = {}
+token_count_cache = {}
 
 # Parsing Arguments
 parser = argparse.ArgumentParser(description=
@@ -107,13 +144,27 @@ parser.add_argument('--load-chat', type=str, help='Name of the chat to load')
 parser.add_argument('--load-last-chat', action='store_true', help='Name of the chat to load')
 parser.add_argument('--list-chats', action='store_true', help='List all chats')
 parser.add_argument('--list-all-chats', action='store_true', help='List all chats including hidden backup chats')
+parser.add_argument('--gc-chats', action='store_true', help='Delete the session backups that backup_retention in the config does not keep, move chats into the message store and delete the messages no chat references anymore.')
+parser.add_argument('--search', type=str, metavar='QUERY', help='Search the messages of all chats for QUERY, and load one of the results.')
 parser.add_argument('--list-models', action='store_true', help='List all models')
 parser.add_argument('--list-models-full', action='store_true', help='List all models and their details')
 parser.add_argument('--speak', default=speak_default, action='store_true', help='Speak the messages.')
-parser.add_argument('-p', '--personality', default='helpful_assistant', type=str, choices=[x.stem for x in prompt_dir.iterdir()], help='Set the system prompt based on predefined file.')
+parser.add_argument('-p', '--personality', default='helpful_assistant', type=str, help='Set the system prompt based on predefined file in the prompts directory.')
 parser.add_argument('--config', action='store_true', help='Open the config file.')
 parser.add_argument('--debug', action='store_true', help='Run with debug settings. Includes notifications.')
 parser.add_argument('--export-chats-to-markdown', action='store_true', help='Re export all named chats as markdown files into the chat directory.')
+parser.add_argument('--backend', default=config.get('backend', 'openai'), choices=['openai', 'record', 'replay'], help='Where completions come from: the OpenAI API, the OpenAI API while recording all requests and responses to --backend-file, or a replay of the recordings in --backend-file.')
+parser.add_argument('--backend-file', type=Path, default=project_dir / 'recordings.jsonl', help='JSONL file of recorded requests and responses for --backend record/replay.')
+parser.add_argument('--replay-delay', type=float, help='Seconds between replayed chunks. By default the recorded timing is used.')
+parser.add_argument('--serve-replay', type=int, metavar='PORT', help='Serve the recordings in --backend-file as a local stand-in for the OpenAI API on PORT. Point api_base in the config at http://localhost:PORT/v1 to use it.')
+parser.add_argument('--batch', type=str, metavar='PROMPTS_FILE', help='Answer the prompts in a JSONL file (- for stdin) concurrently and exit. Every line is an object with a "prompt", and optionally an "id", "personality" and "model".')
+parser.add_argument('--batch-output', type=str, help='JSONL file the batch results are appended to (- for stdout). Prompts that already have a result in it are skipped, such that an interrupted batch can be resumed. Defaults to PROMPTS_FILE with the extension .results.jsonl.')
+parser.add_argument('--batch-workers', type=int, default=config.get('batch_workers', 4), help='Number of concurrent batch requests.')
+parser.add_argument('--batch-order', default='input', choices=['input', 'completed'], help='Write the batch results in the order of the prompts, or as they complete.')
+parser.add_argument('--hedge', nargs='*', metavar='MODEL', default=config.get('hedge_models'), help='Race the same request to several models at once (a model can be listed more than once), and stream the answer that starts first. Without MODELs, two requests to the current model are raced. Defaults to hedge_models in the config.')
+parser.add_argument('--hedge-compare', action='store_true', default=config.get('hedge_compare', False), help='Let the other requests of a race finish, but not for longer than hedge_deadline seconds (10 by default) after the first token, then show all answers side by side and keep the other answers as branches.')
+parser.add_argument('--profile', nargs='?', type=Path, const=project_dir / 'profile.json', metavar='TRACE_FILE', help='Time the phases of the session and write them as a Chrome trace to TRACE_FILE (default: profile.json in the project directory) on exit.')
+parser.add_argument('--profile-phase', type=str, metavar='PHASE', help='Also collect cProfile stats for every span of PHASE, e.g. trim_chat, and write them next to the trace file with the extension .prof. Implies --profile.')
 parser.add_argument('user_input',  type=str, nargs='*', help='Initial input the user gives to the chat bot.')
 args = parser.parse_args()
 if args.user_input == []:
@@ -122,17 +173,112 @@ else:
     args.user_input = " ".join(args.user_input)
     if args.user_input == "":
         args.user_input = None
+if args.profile_phase and args.profile is None:
+    args.profile = project_dir / 'profile.json'
+
+class Profiler:
+    """Timed spans of the phases of a session in all threads, saved in the Chrome trace event format, such that a
+       session can be opened in chrome://tracing or https://ui.perfetto.dev. Optionally the spans of one phase are
+       also profiled with cProfile, and their combined stats are saved next to the trace.
+    """
+    def __init__(self, path=None, cprofile_phase=None):
+        self.path = path
+        self.cprofile_phase = cprofile_phase
+        self.lock = Lock()
+        self.events = []
+        self.thread_names = {}
+        self.stats = None
+        self.cprofile_active = False
+        self.origin = time.perf_counter()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    @contextlib.contextmanager
+    def span(self, name, **span_args):
+        if not self.enabled:
+            yield
+            return
+        profile = self._start_cprofile(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            if profile is not None:
+                self._stop_cprofile(profile)
+            thread = current_thread()
+            event = {'name': name, 'cat': 'gpt_ui', 'ph': 'X', 'pid': os.getpid(), 'tid': thread.ident,
+                     'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6}
+            if span_args:
+                event['args'] = span_args
+            with self.lock:
+                self.events.append(event)
+                self.thread_names[thread.ident] = thread.name
+
+    def profiled(self, name):
+        """Decorator that wraps every call of a function in a span."""
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*f_args, **f_kwargs):
+                with self.span(name):
+                    return f(*f_args, **f_kwargs)
+            return wrapper
+        return decorator
+
+    def _start_cprofile(self, name):
+        if name != self.cprofile_phase:
+            return None
+        with self.lock:
+            # Only one cProfile profiler can be active at a time, so overlapping spans in other threads are skipped
+            if self.cprofile_active:
+                return None
+            self.cprofile_active = True
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def _stop_cprofile(self, profile):
+        profile.disable()
+        with self.lock:
+            self.cprofile_active = False
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+    def save(self):
+        with self.lock:
+            metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+                        for tid, name in self.thread_names.items()]
+            trace = {'traceEvents': metadata + self.events, 'displayTimeUnit': 'ms'}
+            with self.path.open('w') as f:
+                json.dump(trace, f)
+            if self.stats is not None:
+                self.stats.dump_stats(self.path.with_suffix('.prof'))
+        print(f"Profile written to {self.path}")
+
+profiler = Profiler(args.profile, args.profile_phase)
+if profiler.enabled:
+    atexit.register(profiler.save)
 
 assistant_name = 'assistant'
 def GET_DEFAULT_CHAT(): 
-    prompt_path = prompt_dir / (args.personality + ".yaml")
-    if not prompt_path.exists():
-        print(f"Prompt file {prompt_path} does not exist.")
+    try:
+        return personality_chat(args.personality)
+    except FileNotFoundError as e:
+        print(e)
         print("The foolowing prompt files are available:")
         for prompt_file in (project_dir / 'prompts').iterdir():
             print(prompt_file.stem)
         exit(0)
-    return yaml.load(prompt_path.open(), yaml.FullLoader)
+
+def personality_chat(personality):
+    prompt_path = prompt_dir / (personality + ".yaml")
+    if not prompt_path.exists():
+        raise FileNotFoundError(f"Prompt file {prompt_path} does not exist.")
+    return chat_from_json(yaml.load(prompt_path.open(), yaml.FullLoader))
 
 class Command:
     def __init__(self, str_matches, description):
@@ -152,21 +298,36 @@ class Commands:
     load = Command(['load'], 'Load a chat')
     save = Command(['save'], 'Save the chat')
     edit = Command(['vi', 'vim', 'nvim'], 'Edit the chat')
-    regenerate = Command(['regenerate'], 'Regenerate the chat')
+    regenerate = Command(['regenerate'], 'Regenerate the last answer, keeping it on a branch of its own')
     speak = Command(['speak', 's'], 'Speak the messages')
     speak_last = Command(['speak last', 'sl'], 'Speak the last messages')
+    speech_stats = Command(['speech stats'], 'Show hit and miss counters of the speech cache')
+    search = Command(['search', 'find'], 'Search the messages of all chats and load one of them')
+    more = Command(['more', 'scroll'], 'Show the messages before the ones shown last')
+    fork = Command(['fork', 'subtopic'], 'Continue the chat on a new branch, e.g. for a subtopic')
+    switch = Command(['switch'], 'Switch to another branch of the chat')
+    branches = Command(['branches'], 'List the branches of the chat')
+    pop = Command(['pop'], 'Drop the current branch and go back to the branch it was forked from')
     help = Command(['help', 'h'], 'Show this help message')
     def __str__(self) -> str:
         return '\n'.join([str(x) for x in [Commands.exit, Commands.pass_, Commands.restart, Commands.restart_hard, Commands.list, \
                                             Commands.list_all, Commands.load, Commands.save, Commands.edit, \
                                             Commands.regenerate, Commands.speak, Commands.speak_last, \
-                                            Commands.help]])
+                                            Commands.speech_stats, Commands.search, Commands.more, Commands.fork, \
+                                            Commands.switch, Commands.branches, Commands.pop, Commands.help]])
 
 commands = Commands()
 
 def HTML_color(text, color):
     return f'<style fg="ansi{color}">{text}</style>'
 
+def ANSI_color(text, color):
+    """Color text for plain print, where pulling in prompt_toolkit would be too slow."""
+    if not sys.stdout.isatty():
+        return text
+    codes = {'red': 31, 'green': 32, 'blue': 34, 'magenta': 35}
+    return f'\x1b[{codes[color]}m{text}\x1b[0m'
+
 def HTML_bold(text):
     return f'<b>{text}</b>'
 
@@ -188,54 +349,860 @@ def next_role(chat):
     else:
         return "user"
 
-def print_chat(chat):
-    for m in chat:
+def print_messages(messages):
+    for m in messages:
         name = m['model'] if m['role'] == 'assistant' \
                           else (m['user'] if m['role'] == 'user' else 'system')
         prompt = f'{name}:'
         prompt += config['prompt_postfix']
-        pt.print_formatted_text(HTML(f"{color_by_role(m['role'], prompt)}"))
+        pt.print_formatted_text(pt.HTML(f"{color_by_role(m['role'], prompt)}"))
         pt.print_formatted_text(f"{m['content']}")
 
+# Index of the first message print_chat or the more command printed, to scroll further back from
+first_printed_message = 0
+
+def print_chat(chat, n_messages=None):
+    """Print the last n_messages messages of the chat (print_chat_messages in the config, 20 by default)."""
+    global first_printed_message
+    n_messages = n_messages if n_messages is not None else config.get('print_chat_messages', 20)
+    first_printed_message = max(len(chat) - n_messages, 0)
+    if first_printed_message > 0:
+        pt.print_formatted_text(f"({first_printed_message} earlier messages, enter '{commands.more.str_matches[0]}' to show them)")
+    print_messages(chat[first_printed_message:])
+
+def print_earlier_messages(chat, n_messages=None):
+    """Print the n_messages messages before the ones printed last."""
+    global first_printed_message
+    n_messages = n_messages if n_messages is not None else config.get('print_chat_messages', 20)
+    end = min(first_printed_message, len(chat))
+    if end == 0:
+        pt.print_formatted_text("(no earlier messages)")
+        return
+    first_printed_message = max(end - n_messages, 0)
+    pt.print_formatted_text(f"(messages {first_printed_message + 1} to {end} of {len(chat)})")
+    print_messages(chat[first_printed_message:end])
+
+# Marks keys of a Message that are not set
+_missing = object()
+
+class Message(MutableMapping):
+    """A chat message. Behaves like the dict it is stored as in the chat files, but the known keys are slots instead
+       of a dict per message, and the role, model and user strings are interned, such that all messages share them.
+       Other keys go into a dict that is only created when needed. The role and content dict sent to the API is kept
+       until the message changes.
+    """
+    __slots__ = ('role', 'model', 'user', 'date', 'content', 'token_counts', 'extra', '_api_message')
+    # The order of the keys in the chat files
+    known_keys = ('role', 'model', 'user', 'date', 'content', 'token_counts')
+    interned_keys = ('role', 'model', 'user')
+
+    def __init__(self, data=(), **kwargs):
+        self.role = self.model = self.user = self.date = self.content = self.token_counts = _missing
+        self.extra = None
+        self._api_message = None
+        for key, value in dict(data, **kwargs).items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key in Message.known_keys:
+            value = getattr(self, key)
+            if value is _missing:
+                raise KeyError(key)
+            return value
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in Message.known_keys:
+            if key in Message.interned_keys and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in Message.known_keys:
+            if getattr(self, key) is _missing:
+                raise KeyError(key)
+            setattr(self, key, _missing)
+        else:
+            if self.extra is None:
+                raise KeyError(key)
+            del self.extra[key]
+
+    def __iter__(self):
+        for key in Message.known_keys:
+            if getattr(self, key) is not _missing:
+                yield key
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        if isinstance(other, Message):
+            return all(getattr(self, key) == getattr(other, key) for key in Message.known_keys) and (self.extra or {}) == (other.extra or {})
+        return super().__eq__(other)
+
+    def __repr__(self):
+        return f"Message({self.to_dict()!r})"
+
+    def copy(self):
+        """@return: Returns a shallow copy, which shares the strings of this message. The token counts are copied, as
+                    count_tokens updates them in place.
+        """
+        m = Message.__new__(Message)
+        for key in Message.known_keys:
+            setattr(m, key, getattr(self, key))
+        if isinstance(self.token_counts, dict):
+            m.token_counts = dict(self.token_counts)
+        m.extra = dict(self.extra) if self.extra else None
+        m._api_message = self._api_message
+        return m
+
+    def to_dict(self):
+        d = {key: getattr(self, key) for key in Message.known_keys if getattr(self, key) is not _missing}
+        if self.extra:
+            d.update(self.extra)
+        return d
+
+    def api_message(self):
+        api_message = self._api_message
+        if api_message is None or api_message['role'] is not self.role or api_message['content'] is not self.content:
+            api_message = self._api_message = {'role': self.role, 'content': self.content}
+        return api_message
+
+def same_message(a, b):
+    """@return: Returns whether two messages are the same, apart from their token counts, which are only a cache."""
+    if isinstance(a, Message) and isinstance(b, Message):
+        return a.content == b.content and a.role == b.role and a.date == b.date and a.model == b.model \
+            and a.user == b.user and (a.extra or {}) == (b.extra or {})
+    return {k: v for k, v in a.items() if k != 'token_counts'} == {k: v for k, v in b.items() if k != 'token_counts'}
+
+def to_json(obj):
+    """Default for json.dump, which writes messages as the dicts they behave like."""
+    if isinstance(obj, Message):
+        return obj.to_dict()
+    if isinstance(obj, LazyChat):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def chat_from_json(data):
+    return [Message(m) for m in data]
+
+def with_content(m, content):
+    """@return: Returns a copy of the message with other content, sharing all other fields but the token counts,
+                which are of the old content.
+    """
+    m = m.copy()
+    m['content'] = content
+    m.pop('token_counts', None)
+    return m
+
+def api_messages(chat):
+    """@return: Returns the role and content of the messages of a chat, as they are sent to the API."""
+    return [m.api_message() if isinstance(m, Message) else {'role': m['role'], 'content': m['content']} for m in chat]
+
 def append_to_chat(chat, role, content, l_date=None, l_model=None, l_user=None):
     date = timestamp()
-    chat.append({"role": role, "model": l_model if l_model else model, 'user': l_user if l_user else user, 'date': l_date if l_date else date, "content": content})
+    chat.append(Message(role=role, model=l_model if l_model else model, user=l_user if l_user else user, date=l_date if l_date else date, content=content))
     backup_chat(chat)
 
-def number_of_tokens(chat):
+def get_tokenizer(l_model=None):
+    """Return the tokenizer of a model, loading it on first use."""
+    l_model = l_model if l_model else model
+    encoding_name = models_dict.get(l_model, {}).get('encoding', l_model)
+    if encoding_name not in tokenizers:
+        if encoding_name == l_model:
+            tokenizers[encoding_name] = tiktoken.encoding_for_model(l_model)
+        else:
+            tokenizers[encoding_name] = tiktoken.get_encoding(encoding_name)
+    return tokenizers[encoding_name]
+
+def content_hash(content):
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def count_tokens(message, l_model=None):
+    """Count the tokens in the content of a message.
+       The count is cached on the message under 'token_counts' (encoding -> [content hash, count]),
+       such that it is saved alongside the chat, and in a process wide cache keyed by (encoding, content hash).
+    """
+    tokenizer = get_tokenizer(l_model)
+    content = message['content']
+    h = content_hash(content)
+    token_counts = message.get('token_counts')
+    if token_counts and token_counts.get(tokenizer.name, [None])[0] == h:
+        return token_counts[tokenizer.name][1]
+    key = (tokenizer.name, h)
+    if key not in token_count_cache:
+        token_count_cache[key] = len(tokenizer.encode(content, disallowed_special=()))
+    if token_counts is None:
+        token_counts = message['token_counts'] = {}
+    token_counts[tokenizer.name] = [h, token_count_cache[key]]
+    return token_count_cache[key]
+
+def number_of_tokens(chat, l_model=None):
     length = 0
     for c in chat:
-        length += len(enc.encode(c['content']))
+        length += count_tokens(c, l_model)
     return length
 
-def trim_chat(chat):
-    num_tokens = len(enc.encode(chat[0]['content']))
-    new_chat = []
-    for i, e in enumerate(reversed(chat[1:])):
-        num_tokens += len(enc.encode(e['content']))
-        if num_tokens > max_tokens:
+# Every message costs a few tokens on top of its content for the chat format, and the reply is primed with a few more.
+tokens_per_message = 3
+tokens_per_reply = 3
+
+def reserved_completion_tokens(l_model=None):
+    l_model = l_model if l_model else model
+    return config.get('reserved_completion_tokens', {}).get(l_model, models_dict[l_model].get('reserved_completion_tokens', 0))
+
+class ContextIndex:
+    """Token counts of the messages of a chat (including the chat format overhead) as prefix sums.
+       Only messages that changed since the last update are counted again.
+    """
+    def __init__(self):
+        self.encoding = None
+        self.messages = []
+        self.prefix_sums = [0]
+
+    def update(self, chat, l_model=None):
+        encoding = get_tokenizer(l_model).name
+        if encoding != self.encoding:
+            self.__init__()
+            self.encoding = encoding
+        n_valid = 0
+        for (m, content), c in zip(self.messages, chat):
+            if m is not c or content is not c['content']:
+                break
+            n_valid += 1
+        del self.messages[n_valid:]
+        del self.prefix_sums[n_valid + 1:]
+        for c in chat[n_valid:]:
+            self.messages.append((c, c['content']))
+            self.prefix_sums.append(self.prefix_sums[-1] + count_tokens(c, l_model) + tokens_per_message)
+        return self.prefix_sums
+
+context_index = ContextIndex()
+
+def trim_chat(chat, l_model=None, index=None):
+    """Drop the oldest messages such that the chat fits into the context window of the model, leaving room for the
+       completion. A leading system message is always kept. The cut point is found by binary search over the prefix
+       sums of the token counts.
+       @return: Returns a touple of (trimmed chat, number of tokens of the request)
+    """
+    l_model = l_model if l_model else model
+    if len(chat) == 0:
+        return chat, tokens_per_reply
+    prefix_sums = (index if index else context_index).update(chat, l_model)
+    n_head = 1 if chat[0]['role'] == 'system' else 0
+    budget = models_dict[l_model]['max_tokens'] - reserved_completion_tokens(l_model) - tokens_per_reply - prefix_sums[n_head]
+    start = bisect.bisect_left(prefix_sums, prefix_sums[-1] - budget, lo=n_head, hi=len(chat))
+    num_tokens = prefix_sums[n_head] + prefix_sums[-1] - prefix_sums[start] + tokens_per_reply
+    return chat[:n_head] + chat[start:], num_tokens
+
+def chat_index_path(path):
+    return path.with_name(f".{path.name}.idx")
+
+def dump_chat(chat):
+    """Serialize a chat the way json.dump with indent=4 does, keeping track of where every message ends up.
+       @return: Returns a touple of (JSON text, [start, end] offset of every message in the text)
+    """
+    if len(chat) == 0:
+        return '[]', []
+    parts = ['[\n']
+    spans = []
+    position = 2
+    for i, m in enumerate(chat):
+        if i > 0:
+            parts.append(',\n')
+            position += 2
+        # JSON strings never contain a raw newline, so indenting after every newline indents just the structure
+        text = '    ' + json.dumps(m, indent=4, default=to_json).replace('\n', '\n    ')
+        parts.append(text)
+        spans.append([position + 4, position + len(text)])
+        position += len(text)
+    parts.append('\n]')
+    # The text is ASCII (json.dumps escapes everything else), so these are byte offsets as well
+    return ''.join(parts), spans
+
+class MessageStore:
+    """Content addressed store of chat messages, a SQLite database in the directory of the chats. Chats written in
+       the store format only hold the hashes of their messages, so messages that backups and named chats have in
+       common, like the system prompt or the history of a chat that was loaded again, are stored once.
+       The token counts of the messages are kept in a table of their own, such that they are not counted again after
+       loading, but do not change the hash of a message when it is counted.
+    """
+    file_name = '.messages.sqlite'
+
+    def __init__(self, path):
+        self.path = path
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10)
+        db.execute('CREATE TABLE IF NOT EXISTS messages (hash TEXT PRIMARY KEY, data TEXT) WITHOUT ROWID')
+        db.execute('CREATE TABLE IF NOT EXISTS token_counts (hash TEXT, encoding TEXT, content_hash TEXT, count INTEGER, '
+                   'PRIMARY KEY (hash, encoding)) WITHOUT ROWID')
+        return db
+
+    @staticmethod
+    def serialize(m):
+        """@return: Returns a touple of (hash, JSON) of a message, without its token counts"""
+        data = json.dumps({k: v for k, v in m.items() if k != 'token_counts'}, sort_keys=True, default=to_json)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest(), data
+
+    @contextlib.contextmanager
+    def writing(self):
+        """Transaction for storing messages and writing the chat that references them, which gc_chats waits for."""
+        db = self._connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            yield db
+            db.commit()
+        finally:
+            db.close()
+
+    def put(self, db, chat):
+        """Store the messages of a chat that are not stored yet.
+           @return: Returns the hashes of the messages.
+        """
+        if isinstance(chat, LazyChat) and isinstance(chat.source, MessageStore) and chat.source.path == self.path:
+            # Messages that were not read from this store yet are still in it as they are
+            hashes = chat.unread_keys()
+        else:
+            hashes = [None] * len(chat)
+        objects = []
+        counts = []
+        for i, h in enumerate(hashes):
+            if h is None:
+                objects.append(MessageStore.serialize(chat[i]))
+                hashes[i] = objects[-1][0]
+                for encoding, (h_content, count) in (chat[i].get('token_counts') or {}).items():
+                    counts.append((hashes[i], encoding, h_content, count))
+        db.executemany('INSERT OR IGNORE INTO messages VALUES (?, ?)', objects)
+        db.executemany('INSERT OR IGNORE INTO token_counts VALUES (?, ?, ?, ?)', counts)
+        return hashes
+
+    def read(self, hashes):
+        data = {}
+        counts = {}
+        unique = list(set(hashes))
+        with self._connect() as db:
+            # Stay below the limit of SQLite on the number of parameters
+            for i in range(0, len(unique), 500):
+                chunk = unique[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                data.update(db.execute(f"SELECT hash, data FROM messages WHERE hash IN ({placeholders})", chunk))
+                for h, encoding, h_content, count in db.execute(
+                        f"SELECT hash, encoding, content_hash, count FROM token_counts WHERE hash IN ({placeholders})", chunk):
+                    counts.setdefault(h, {})[encoding] = [h_content, count]
+        if len(data) < len(unique):
+            raise KeyError(f"{len(unique) - len(data)} messages are missing from the message store {self.path}")
+        messages = []
+        for h in hashes:
+            m = Message(json.loads(data[h]))
+            if h in counts:
+                m['token_counts'] = {encoding: list(c) for encoding, c in counts[h].items()}
+            messages.append(m)
+        return messages
+
+    def vacuum(self):
+        db = self._connect()
+        db.execute('VACUUM')
+        db.close()
+
+    def delete_unreferenced(self, db, referenced):
+        """@return: Returns the number of deleted messages."""
+        db.execute('CREATE TEMP TABLE referenced (hash TEXT PRIMARY KEY)')
+        db.executemany('INSERT OR IGNORE INTO referenced VALUES (?)', ((h,) for h in referenced))
+        db.execute('DELETE FROM token_counts WHERE hash NOT IN (SELECT hash FROM referenced)')
+        return db.execute('DELETE FROM messages WHERE hash NOT IN (SELECT hash FROM referenced)').rowcount
+
+def read_chat_file(path):
+    """Read a chat file, which is either a JSON list of messages or the hashes of its messages in a message store."""
+    with path.open() as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        return MessageStore(path.parent / data['message_store']).read(data['messages'])
+    return chat_from_json(data)
+
+def replace_file(path, text):
+    # Write to a temporary file first, such that a crash never leaves a half written file behind
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with tmp_path.open("w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def branches_path(path):
+    return path.with_name(f".{path.name}.branches")
+
+def write_chat_file(chat, path, branches=None):
+    """Write a chat in the format chat_storage in the config asks for. With 'store' (the default) the messages go into
+       the message store next to the chat, and the chat file only holds their hashes. With 'json' the chat file holds
+       the messages, and an index of their offsets in it is written next to it, which LazyChat reads it by.
+       The other branches of the chat (see ChatTree.saved) go into the chat file or, for 'json', into a file next to it.
+    """
+    if config.get('chat_storage', 'store') == 'store':
+        store = MessageStore(path.parent / MessageStore.file_name)
+        with store.writing() as db:
+            data = {'message_store': MessageStore.file_name, 'messages': store.put(db, chat)}
+            if branches:
+                data.update(branches, branches={name: dict(b, messages=store.put(db, b['messages']))
+                                                for name, b in branches['branches'].items()})
+            replace_file(path, json.dumps(data))
+        chat_index_path(path).unlink(missing_ok=True)
+        branches_path(path).unlink(missing_ok=True)
+        return
+    text, spans = dump_chat(chat)
+    replace_file(path, text)
+    # The index is only used if the size and mtime of the chat still match, so a stale one does no harm
+    stat = path.stat()
+    with chat_index_path(path).open('w') as f:
+        json.dump({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'spans': spans}, f)
+    if branches:
+        replace_file(branches_path(path), json.dumps(branches, default=to_json))
+    else:
+        branches_path(path).unlink(missing_ok=True)
+
+def read_chat_branches(path):
+    """@return: Returns the branches saved with a chat as ChatTree.saved returns them, or None if there are none."""
+    if branches_path(path).exists():
+        with branches_path(path).open() as f:
+            saved = json.load(f)
+        for b in saved['branches'].values():
+            b['messages'] = chat_from_json(b['messages'])
+        return saved
+    with path.open('rb') as f:
+        # Chats written as JSON are not read just to find out that they have no branches
+        if f.read(1) != b'{':
+            return None
+        f.seek(0)
+        data = json.load(f)
+    if 'parents' not in data:
+        return None
+    store = MessageStore(path.parent / data['message_store'])
+    for b in data['branches'].values():
+        b['messages'] = store.read(b['messages'])
+    return {key: data[key] for key in ['branch', 'parents', 'branches']}
+
+def write_chat(chat, path):
+    write_chat_file(chat, path, chat_tree.saved(chat))
+    chat_catalog.update(path, chat, summary=bottom_toolbar_session.summary)
+
+def journal_path(path):
+    return path.with_suffix('.journal.jsonl')
+
+def orphaned_journal(path) -> bool:
+    """@return: Returns whether a chat has a journal with records that no running session writes anymore. Sessions
+                hold a lock on the journal they write.
+    """
+    try:
+        with journal_path(path).open() as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return False
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            return True
+    except FileNotFoundError:
+        return False
+
+def replay_journal(chat, path):
+    """Apply the records of a journal to a chat. Records are {"i": index, "message": message}, setting or appending
+       a message, and {"truncate": length}. Replaying is idempotent, so a journal that was already compacted into
+       the chat (e.g. because we crashed during compaction) does no harm.
+    """
+    with path.open() as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line might be cut off if we crashed while writing it
+                break
+            if 'truncate' in record:
+                del chat[record['truncate']:]
+            elif record['i'] == len(chat):
+                chat.append(Message(record['message']))
+            elif record['i'] < len(chat):
+                chat[record['i']] = Message(record['message'])
+    return chat
+
+class SpanReader:
+    """Reads messages from a chat file by their [start, end] offsets in it. The file is kept open, so messages that
+       were not read yet stay the same when the chat file is overwritten in the meantime.
+    """
+    def __init__(self, file):
+        self.file = file
+
+    def read(self, spans):
+        begin = spans[0][0]
+        data = os.pread(self.file.fileno(), spans[-1][1] - begin, begin)
+        return [Message(json.loads(data[start - begin:end - begin])) for start, end in spans]
+
+    def close(self):
+        self.file.close()
+
+class LazyChat(MutableSequence):
+    """A chat that reads its messages only when they are needed, a page of page_size messages at a time, from a
+       source: the message store for chats written as hashes, or a SpanReader for chats written as JSON, with the
+       index of the offsets of the messages write_chat writes next to them. Messages that are added or replaced are
+       kept in memory like in a list.
+    """
+    page_size = 256
+
+    def __init__(self, source, keys):
+        self.source = source
+        # Key of each message in the source (a hash or a span), None for messages that are not from the source
+        self.keys = keys
+        # None for messages that were not read yet
+        self.messages = [None] * len(keys)
+        self.lock = Lock()
+
+    @staticmethod
+    def open(path):
+        """@return: Returns the chat at path as a LazyChat, or None if it is a JSON chat without an up to date index."""
+        file = path.open('rb')
+        if file.read(1) == b'{':
+            file.seek(0)
+            with file:
+                data = json.load(file)
+            return LazyChat(MessageStore(path.parent / data['message_store']), data['messages'])
+        try:
+            with chat_index_path(path).open() as f:
+                index = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            file.close()
+            return None
+        stat = os.fstat(file.fileno())
+        if index.get('size') != stat.st_size or index.get('mtime_ns') != stat.st_mtime_ns:
+            file.close()
+            return None
+        return LazyChat(SpanReader(file), index['spans'])
+
+    def _read_page(self, i):
+        """Read the messages of the page around index i that were not read yet. Must be called with the lock held."""
+        start = i - i % LazyChat.page_size
+        missing = [j for j in range(start, min(start + LazyChat.page_size, len(self.messages)))
+                   if self.messages[j] is None]
+        if not missing:
+            return
+        for j, m in zip(missing, self.source.read([self.keys[j] for j in missing])):
+            self.messages[j] = m
+        if None not in self.messages and hasattr(self.source, 'close'):
+            # Nothing is left to read
+            self.source.close()
+
+    def _get(self, i):
+        if i < 0:
+            i += len(self.messages)
+        m = self.messages[i]
+        if m is None:
+            with self.lock:
+                if self.messages[i] is None:
+                    self._read_page(i)
+                m = self.messages[i]
+        return m
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._get(j) for j in range(*i.indices(len(self.messages)))]
+        return self._get(i)
+
+    def __setitem__(self, i, m):
+        with self.lock:
+            if isinstance(i, slice):
+                m = list(m)
+                self.keys[i] = [None] * len(m)
+            else:
+                self.keys[i] = None
+            self.messages[i] = m
+
+    def __delitem__(self, i):
+        with self.lock:
+            del self.messages[i]
+            del self.keys[i]
+
+    def insert(self, i, m):
+        with self.lock:
+            self.messages.insert(i, m)
+            self.keys.insert(i, None)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        i = 0
+        while i < len(self.messages):
+            yield self._get(i)
+            i += 1
+
+    def __eq__(self, other):
+        return isinstance(other, (list, LazyChat)) and list(self) == list(other)
+
+    def __repr__(self):
+        return f"LazyChat({sum(m is not None for m in self.messages)}/{len(self.messages)} messages read)"
+
+    def n_unread(self):
+        return self.messages.count(None)
+
+    def unread_keys(self):
+        """@return: Returns the keys of the messages that were not read yet, and None for the others."""
+        with self.lock:
+            return [k if m is None else None for k, m in zip(self.keys, self.messages)]
+
+    def read_all(self):
+        """Read all messages, newest pages first, as they are the ones that are needed first."""
+        for i in reversed(range(0, len(self.messages), LazyChat.page_size)):
+            with self.lock:
+                if i < len(self.messages):
+                    self._read_page(i)
+
+def load_chat(path):
+    """Load a chat with its branches as the chat of the session, replaying its journal if there is one left over from
+       a crashed session.
+       Chats that are longer than a page are loaded lazily: the messages that are shown and sent first are read
+       right away, and the others in a background thread (unless lazy_chat_prefetch is off, then they are read when
+       something needs them).
+    """
+    chat = []
+    if path.exists():
+        chat = LazyChat.open(path)
+        if chat is None:
+            chat = read_chat_file(path)
+        elif len(chat) <= LazyChat.page_size:
+            chat = list(chat)
+        else:
+            # The last page is shown and sent first
+            chat[-1]
+            if config.get('lazy_chat_prefetch', True):
+                Thread(target=chat.read_all, name='chat prefetch', daemon=True).start()
+        chat_tree.restore(chat, read_chat_branches(path))
+    else:
+        chat_tree.reset()
+    if journal_path(path).exists():
+        chat = replay_journal(chat, journal_path(path))
+        if orphaned_journal(path):
+            # Compact the journal of a crashed session, such that it is not replayed on every load
+            write_chat(chat, path)
+            journal_path(path).unlink()
+    return chat
+
+def shared_prefix_length(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x is not y and x != y:
             break
-        new_chat.append(e)
-    new_chat = list(reversed(new_chat))
-    return [chat[0]] + new_chat, num_tokens
+        n += 1
+    return n
+
+class ChatTree:
+    """The branches of the session chat. Every branch but the root forked from a parent branch, and shares the
+       messages up to the fork with it. The session chat is the active branch, the other branches are kept as lists of
+       the very same Message objects, so the history they share is not copied, and the token counts and exploded
+       content cached for its messages serve all branches, which makes switching between them cheap.
+    """
+    root = 'main'
 
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.active = ChatTree.root
+        self.parents = {ChatTree.root: None}
+        # The chats of the branches that are not active
+        self.chats = {}
+
+    def _new_name(self, prefix):
+        i = 1
+        while f'{prefix}{i}' in self.parents:
+            i += 1
+        return f'{prefix}{i}'
+
+    def fork(self, chat, name=None):
+        """Continue the chat on a new branch, leaving the active branch as it is.
+           @return: Returns the name of the new branch.
+        """
+        name = name if name else self._new_name('branch-')
+        if name in self.parents:
+            raise ValueError(f"Branch {name} already exists.")
+        self.chats[self.active] = list(chat)
+        self.parents[name] = self.active
+        self.active = name
+        return name
+
+    def keep_alternative(self, chat):
+        """Keep the chat as it is now as a branch next to the active one, e.g. before its last answer is regenerated.
+           @return: Returns the name of the new branch.
+        """
+        name = self._new_name(f'{self.active}~')
+        self.chats[name] = list(chat)
+        self.parents[name] = self.active
+        return name
+
+    def switch(self, chat, name):
+        """@return: Returns the chat of the branch name, which becomes the active one."""
+        if name not in self.parents:
+            raise ValueError(f"There is no branch {name}.")
+        if name == self.active:
+            return chat
+        self.chats[self.active] = chat
+        self.active = name
+        return self.chats.pop(name)
+
+    def pop(self, chat):
+        """Drop the active branch and switch to its parent. Branches forked from it become branches of the parent.
+           @return: Returns the chat of the parent.
+        """
+        parent = self.parents[self.active]
+        if parent is None:
+            raise ValueError(f"The {self.active} branch can not be popped.")
+        for name, p in self.parents.items():
+            if p == self.active:
+                self.parents[name] = parent
+        del self.parents[self.active]
+        self.active = parent
+        return self.chats.pop(parent)
+
+    def branches(self, chat):
+        """@return: Returns a list of (name, parent, chat) of all branches, with chat as the one of the active branch."""
+        return [(name, parent, chat if name == self.active else self.chats[name]) for name, parent in self.parents.items()]
+
+    def saved(self, chat):
+        """The branches to save along with chat as the active branch. Of the other branches only the messages after
+           the ones they share with their parent are saved.
+           @return: Returns {'branch': active branch, 'parents': {branch: parent}, 'branches': {branch: {'shared':
+                    number of messages shared with the parent, 'messages': the messages after those}}}, or None if
+                    there is only the active branch.
+        """
+        if len(self.chats) == 0:
+            return None
+        branches = {}
+        for name, parent, branch_chat in self.branches(chat):
+            if name == self.active:
+                continue
+            shared = 0 if parent is None else shared_prefix_length(branch_chat, chat if parent == self.active else self.chats[parent])
+            branches[name] = {'shared': shared, 'messages': branch_chat[shared:]}
+        return {'branch': self.active, 'parents': dict(self.parents), 'branches': branches}
+
+    def restore(self, chat, saved):
+        """Restore the branches saved along with chat. The messages a branch shares with its parent are the same
+           Message objects in both.
+        """
+        self.reset()
+        if not saved:
+            return
+        self.active = saved['branch']
+        self.parents = dict(saved['parents'])
+        chats = {self.active: chat}
+        def resolve(name):
+            if name not in chats:
+                parent = self.parents[name]
+                branch = saved['branches'][name]
+                chats[name] = (resolve(parent)[:branch['shared']] if parent is not None else []) + branch['messages']
+            return chats[name]
+        for name in self.parents:
+            resolve(name)
+        del chats[self.active]
+        self.chats = chats
+
+chat_tree = ChatTree()
+
+class ChatJournal:
+    """Append only journal for the session backup. Instead of rewriting the whole backup on every message, only the
+       messages that were added or changed since the last write are appended to a JSONL file next to the backup.
+       Writes are fsynced at most every fsync_interval seconds, and the journal is compacted into the backup after
+       compact_interval records and on exit. The journal is locked while it is written, such that the journal of a
+       crashed session can be told apart and compacted by load_chat and gc_chats.
+    """
+    def __init__(self, path, fsync_interval=1.0, compact_interval=200):
+        self.path = path
+        self.journal_path = journal_path(path)
+        self.fsync_interval = fsync_interval
+        self.compact_interval = compact_interval
+        self.snapshot = []
+        self.file = None
+        self.n_records = 0
+        self.last_fsync = 0
+        self.needs_fsync = False
+
+    def write(self, chat):
+        if not self.path.exists():
+            self.snapshot = [m.copy() for m in chat]
+            self.compact()
+            return
+        n_same = 0
+        for old, new in zip(self.snapshot, chat):
+            if not same_message(old, new):
+                break
+            n_same += 1
+        records = []
+        if n_same < len(self.snapshot):
+            records.append({'truncate': n_same})
+        records += [{'i': i, 'message': chat[i]} for i in range(n_same, len(chat))]
+        if len(records) == 0:
+            return
+        del self.snapshot[n_same:]
+        self.snapshot += [m.copy() for m in chat[n_same:]]
+        if self.file is None:
+            self.file = self.journal_path.open('a')
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        self.file.write(''.join(json.dumps(r, default=to_json) + '\n' for r in records))
+        self.file.flush()
+        self.needs_fsync = True
+        self.n_records += len(records)
+        if time.time() - self.last_fsync > self.fsync_interval:
+            self.fsync()
+        if self.n_records >= self.compact_interval:
+            self.compact()
+
+    def fsync(self):
+        if self.file is not None and self.needs_fsync:
+            os.fsync(self.file.fileno())
+            # The catalog is updated as often as the journal is synced, and not on every write
+            chat_catalog.update(self.path, self.snapshot, summary=bottom_toolbar_session.summary)
+        self.needs_fsync = False
+        self.last_fsync = time.time()
+
+    def compact(self):
+        """Write the journaled chat as a whole into the backup, and start a new journal."""
+        if len(self.snapshot) == 0 or (self.n_records == 0 and self.path.exists()):
+            return
+        write_chat(self.snapshot, self.path)
+        # Removed before it is unlocked, such that it is never taken for the journal of a crashed session
+        self.journal_path.unlink(missing_ok=True)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.n_records = 0
+        self.needs_fsync = False
+
+chat_journal = ChatJournal(
+    chat_backup_file,
+    fsync_interval=config.get('journal_fsync_interval', 1.0),
+    compact_interval=config.get('journal_compact_interval', 200))
+atexit.register(chat_journal.compact)
+
+@profiler.profiled('backup_chat')
 def backup_chat(chat, name=None, prompt_name=None):
     if len(chat) == 0:
         return
     # Always backup chat first, even if we are prompting for a name
-    with ensure_extension(chat_backup_file, ".json").open("w") as f:
-        json.dump(chat, f, indent=4)
+    if config.get('chat_backup_mode', 'journal') == 'journal':
+        chat_journal.write(chat)
+    else:
+        write_chat(chat, chat_backup_file)
     if prompt_name:
         try:
             user_input_name = pt.prompt("Save name: ")
-            with (chat_dir / ensure_extension(user_input_name, "json")).open("w") as f:
-                json.dump(chat, f, indent=4)
+            write_chat(chat, chat_dir / ensure_extension(user_input_name, ".json"))
             return user_input_name
         except EOFError as e:
             pass
     elif name:
-        with (chat_dir / ensure_extension(name, '.json')).open("w") as f:
-            json.dump(chat, f, indent=4)
+        write_chat(chat, chat_dir / ensure_extension(name, '.json'))
         return name
     else:
         return chat_backup_file
@@ -245,7 +1212,7 @@ def edit_chat(chat, user_input):
     meta_data_prefix = f"###>>>"
     with (chat_dir / 'temp').open("w") as f:
         for m in chat:
-            meta_data = json.dumps({k: v for k, v in m.items() if k != 'content'})
+            meta_data = json.dumps({k: v for k, v in m.items() if k not in ['content', 'token_counts']})
             f.write(f"{meta_data_prefix}{meta_data}\n{m['content']}\n\n")
         meta_data = json.dumps({'role': next_role(chat), 'model': model, 'user': user, 'date': timestamp()})
         f.write(f"{meta_data_prefix}{meta_data}\n\n")
@@ -269,7 +1236,6 @@ def edit_chat(chat, user_input):
                         l_date=r['date'] if r and 'date' in r else None, 
                         l_user=r['user'] if r and 'user' in r else None,
                         l_model=r['model'] if r and 'model' in r else None)
-                backup_chat(chat)
                 text = ""
                 role = r['role']
             else:
@@ -297,53 +1263,406 @@ def edit_chat(chat, user_input):
 #         hash = hashlib.md5(text.encode('utf-8')).hexdigest()
 #     speak(text)
 
+class ChatCatalog:
+    """Sidecar index of the chats in chat_dir, such that listing and loading chats does not need to open every chat
+       file. Rows are updated whenever backup_chat writes a chat, and revalidated against the mtime and size of the
+       chat files, so chats changed by other means are picked up too.
+       The messages of all chats are kept in a full text index (SQLite FTS5) for search. Messages are indexed by
+       their hash in the message store, such that messages that several chats have in common are indexed once. When
+       a chat is updated, only the messages after the first one that changed are indexed again.
+    """
+    schema_version = 2
+
+    def __init__(self, path, directory):
+        self.path = path
+        self.directory = directory
+        # Prefix hashes of the chat that was indexed last, which usually is the one of the session
+        self.indexed_name = None
+        self.indexed_hashes = []
+        self.prefix_hashes = None
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10)
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        if version < self.schema_version:
+            # Catalogs from before the index by message hash need all chats read again
+            db.executescript("""
+                DROP TABLE IF EXISTS chats;
+                DROP TABLE IF EXISTS messages_fts;
+                DROP TABLE IF EXISTS messages;
+                """)
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS chats (name TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER,
+                n_messages INTEGER, last_message TEXT, model TEXT, summary TEXT);
+            CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, hash TEXT UNIQUE, role TEXT, date TEXT,
+                content TEXT);
+            CREATE TABLE IF NOT EXISTS chat_messages (name TEXT, position INTEGER, prefix_hash TEXT, message_id INTEGER,
+                PRIMARY KEY (name, position)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS chat_messages_by_message ON chat_messages (message_id);
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, content='messages', content_rowid='id',
+                tokenize='porter unicode61');
+            CREATE TRIGGER IF NOT EXISTS messages_insert AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_delete AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            END;
+            """)
+        if version < self.schema_version:
+            db.execute(f'PRAGMA user_version = {self.schema_version}')
+        return db
+
+    def update(self, path, chat, summary=None):
+        with self._connect() as db:
+            self._update(db, path, chat, summary)
+
+    def _update(self, db, path, chat, summary=None):
+        stat = path.stat()
+        if summary is None:
+            row = db.execute('SELECT summary FROM chats WHERE name = ?', (path.name,)).fetchone()
+            summary = row[0] if row else ''
+        last_message = textwrap.shorten(chat[-1]['content'], width=100) if chat else ''
+        l_model = chat[-1].get('model', '') if chat else ''
+        db.execute('INSERT OR REPLACE INTO chats VALUES (?, ?, ?, ?, ?, ?, ?)',
+                   (path.name, stat.st_mtime_ns, stat.st_size, len(chat), last_message, l_model, summary))
+        self._index_messages(db, path.name, chat)
+
+    def _index_messages(self, db, name, chat):
+        if name != self.indexed_name:
+            self.indexed_name = name
+            self.prefix_hashes = PrefixHashes()
+            self.indexed_hashes = [h for h, in db.execute(
+                'SELECT prefix_hash FROM chat_messages WHERE name = ? ORDER BY position', (name,))]
+        hashes = self.prefix_hashes.update(chat)
+        n_same = 0
+        for old, new in zip(self.indexed_hashes, hashes):
+            if old != new:
+                break
+            n_same += 1
+        if n_same < len(self.indexed_hashes):
+            self._unindex(db, 'name = ? AND position >= ?', (name, n_same))
+        messages = [(MessageStore.serialize(m)[0], m) for m in chat[n_same:]]
+        db.executemany('INSERT OR IGNORE INTO messages (hash, role, date, content) VALUES (?, ?, ?, ?)',
+                       [(h, m['role'], m.get('date', ''), m['content']) for h, m in messages])
+        db.executemany('INSERT INTO chat_messages VALUES (?, ?, ?, (SELECT id FROM messages WHERE hash = ?))',
+                       [(name, i, hashes[i], h) for i, (h, m) in enumerate(messages, n_same)])
+        self.indexed_hashes = list(hashes)
+
+    def _unindex(self, db, where, parameters):
+        """Remove messages from chats in the index, and the messages that are in no chat anymore."""
+        ids = {i for i, in db.execute(f'SELECT message_id FROM chat_messages WHERE {where}', parameters)}
+        db.execute(f'DELETE FROM chat_messages WHERE {where}', parameters)
+        db.executemany('DELETE FROM messages WHERE id = ? AND NOT EXISTS (SELECT 1 FROM chat_messages WHERE message_id = ?)',
+                       [(i, i) for i in ids])
+
+    def refresh(self):
+        """Bring the catalog in sync with the chat files on disk, only reading chats whose mtime or size changed."""
+        with self._connect() as db:
+            known = {name: (mtime_ns, size) for name, mtime_ns, size in db.execute('SELECT name, mtime_ns, size FROM chats')}
+            on_disk = set()
+            # All changed chats are updated in one transaction
+            for entry in os.scandir(self.directory):
+                if not entry.is_file() or not entry.name.endswith('.json'):
+                    continue
+                on_disk.add(entry.name)
+                stat = entry.stat()
+                if known.get(entry.name) != (stat.st_mtime_ns, stat.st_size):
+                    try:
+                        chat = read_chat_file(Path(entry.path))
+                    except (json.JSONDecodeError, UnicodeDecodeError, KeyError):
+                        chat = []
+                    self._update(db, Path(entry.path), chat)
+            db.executemany('DELETE FROM chats WHERE name = ?', [(name,) for name in known.keys() - on_disk])
+            for name in known.keys() - on_disk:
+                self._unindex(db, 'name = ?', (name,))
+        if self.indexed_name not in on_disk:
+            self.indexed_name = None
+
+    def chats(self, hide_backups=True):
+        self.refresh()
+        with self._connect() as db:
+            rows = db.execute('SELECT name, n_messages, last_message, model, summary FROM chats ORDER BY name').fetchall()
+        return [r for r in rows if not (hide_backups and r[0].startswith('.'))]
+
+    def search(self, query, limit=20):
+        """Rank the messages that contain all words of the query with bm25. A message that is in several chats, e.g.
+           in the backups of a chat that was loaded again, is indexed and returned once, for the named chat it is in
+           or else the latest backup.
+           @return: Returns a list of (chat name, role, date, snippet)
+        """
+        self.refresh()
+        # Quote every word, such that punctuation in the query is not read as FTS5 syntax
+        match = ' '.join('"' + word.replace('"', '""') + '"' for word in query.split())
+        if match == '':
+            return []
+        with self._connect() as db:
+            return db.execute(
+                "SELECT (SELECT name FROM chat_messages WHERE message_id = m.id ORDER BY name LIKE '.%', name DESC LIMIT 1) AS chat, "
+                "m.role, m.date, snippet(messages_fts, 0, '**', '**', '...', 16) FROM messages_fts "
+                "JOIN messages m ON m.id = messages_fts.rowid WHERE messages_fts MATCH ? "
+                "ORDER BY bm25(messages_fts), chat LIKE '.%', chat DESC LIMIT ?", (match, limit)).fetchall()
+
+    def vacuum(self):
+        db = self._connect()
+        db.execute('VACUUM')
+        db.close()
+
+    def last_backup(self) -> Optional[Path]:
+        self.refresh()
+        with self._connect() as db:
+            row = db.execute("SELECT name FROM chats WHERE name LIKE '.backup%' ORDER BY name DESC LIMIT 1").fetchone()
+        return self.directory / row[0] if row else None
+
+chat_catalog = ChatCatalog(chat_catalog_file, chat_dir)
+
 def list_chats(hide_backups=True):
-    for chats in sorted(chat_dir.iterdir()):
-        if chats.is_dir() or chats.name.endswith('.md'):
-            continue
-        color = 'green'
-        if hide_backups and chats.name.startswith('.'):
-            continue
-        if chats.name.startswith('.backup'):
-            color = 'magenta'
-        pt.print_formatted_text(HTML(HTML_color(html.escape(chats.name), color)))
-        with chats.open() as f:
-            chat = json.load(f)
-            print(textwrap.shorten(chat[-1]['content'], width=100))
+    for name, n_messages, last_message, l_model, summary in chat_catalog.chats(hide_backups):
+        color = 'magenta' if name.startswith('.backup') else 'green'
+        print(ANSI_color(name, color))
+        print(last_message)
         print()
 
+def backups_to_keep(names, keep_last, keep_daily):
+    """Retention policy of the session backups: the keep_last latest backups, and the latest backup of each of the
+       keep_daily latest days with backups.
+       @return: Returns the set of names of the backups to keep.
+    """
+    # The timestamp in the names of the backups sorts them by time
+    names = sorted(names, reverse=True)
+    latest_of_day = {}
+    for name in names:
+        latest_of_day.setdefault(name[len('.backup_'):][:len('2023-05-13')], name)
+    return set(names[:keep_last]) | set(list(latest_of_day.values())[:keep_daily])
+
+def directory_size(directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+def gc_chats(keep_last=None, keep_daily=None):
+    """Delete the session backups that the retention policy (backup_retention in the config) does not keep, move the
+       chats that are still written as JSON into the message store, and delete the messages no chat references anymore.
+       The journals of crashed sessions are compacted into their backups first, and backups whose session is still
+       running are always kept.
+       @return: Returns a touple of (deleted backups, chats moved into the store, deleted messages, bytes reclaimed)
+    """
+    retention = config.get('backup_retention', {})
+    keep_last = keep_last if keep_last is not None else retention.get('keep_last', 20)
+    keep_daily = keep_daily if keep_daily is not None else retention.get('keep_daily', 30)
+    # The catalog is brought up to date first, such that only what the collection reclaims counts
+    chat_catalog.refresh()
+    size_before = directory_size(chat_dir)
+    chat_files = [Path(e.path) for e in os.scandir(chat_dir) if e.is_file() and e.name.endswith('.json')]
+    for p in chat_files:
+        if orphaned_journal(p):
+            try:
+                write_chat_file(replay_journal(read_chat_file(p), journal_path(p)), p, read_chat_branches(p))
+            except (json.JSONDecodeError, UnicodeDecodeError, KeyError):
+                continue
+            journal_path(p).unlink()
+    keep = backups_to_keep([p.name for p in chat_files if p.name.startswith('.backup_')], keep_last, keep_daily)
+    deleted = [p for p in chat_files if p.name.startswith('.backup_') and p.name not in keep and not journal_path(p).exists()]
+    for p in deleted:
+        p.unlink()
+        chat_index_path(p).unlink(missing_ok=True)
+        branches_path(p).unlink(missing_ok=True)
+    chat_files = [p for p in chat_files if p not in deleted]
+
+    n_moved = 0
+    if config.get('chat_storage', 'store') == 'store':
+        for p in chat_files:
+            try:
+                with p.open() as f:
+                    data = json.load(f)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                continue
+            if isinstance(data, list):
+                # Keep the mtime, as it tells when the chat was last changed
+                stat = p.stat()
+                write_chat_file(chat_from_json(data), p, read_chat_branches(p))
+                os.utime(p, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+                n_moved += 1
+    for entry in os.scandir(chat_dir):
+        for suffix in ['.idx', '.branches']:
+            if entry.name.endswith('.json' + suffix) and not (chat_dir / entry.name[1:-len(suffix)]).exists():
+                os.unlink(entry.path)
+
+    n_deleted_messages = 0
+    store = MessageStore(chat_dir / MessageStore.file_name)
+    if store.path.exists():
+        # Sessions wait with writing chats until the references are collected and the messages deleted
+        with store.writing() as db:
+            referenced = set()
+            for p in chat_files:
+                try:
+                    with p.open() as f:
+                        data = json.load(f)
+                except (OSError, json.JSONDecodeError, UnicodeDecodeError):
+                    continue
+                if isinstance(data, dict) and data.get('message_store') == MessageStore.file_name:
+                    referenced.update(data['messages'])
+                    for b in data.get('branches', {}).values():
+                        referenced.update(b['messages'])
+            n_deleted_messages = store.delete_unreferenced(db, referenced)
+        store.vacuum()
+    chat_catalog.refresh()
+    chat_catalog.vacuum()
+    return len(deleted), n_moved, n_deleted_messages, size_before - directory_size(chat_dir)
+
+def print_branches(chat):
+    for name, parent, branch_chat in chat_tree.branches(chat):
+        marker = '*' if name == chat_tree.active else ' '
+        forked = f", forked from {parent}" if parent else ''
+        print(f"{marker} {ANSI_color(name, 'green')}{forked}, {len(branch_chat)} messages")
+        if branch_chat:
+            print(f"  {textwrap.shorten(branch_chat[-1]['content'], width=100)}")
+
+def search_chats(query) -> Optional[Path]:
+    """Show the search results for query, and let the user choose a chat to load.
+       @return: Returns the path of the chosen chat, or None.
+    """
+    results = chat_catalog.search(query, limit=config.get('search_results', 20))
+    if len(results) == 0:
+        print(f"No messages found for: {query}")
+        return None
+    for i, (name, role, date, snippet) in enumerate(results, 1):
+        color = 'magenta' if name.startswith('.backup') else 'green'
+        print(f"{i}: {ANSI_color(name, color)} {role} {date}")
+        print(f"   {snippet}")
+    try:
+        choice = pt.prompt('Number of chat to load: ').strip()
+    except EOFError:
+        return None
+    if not choice.isdigit() or not 1 <= int(choice) <= len(results):
+        return None
+    return chat_dir / results[int(choice) - 1][0]
+
+# Files larger than this are read through mmap. Only up to max_embedded_file_bytes of a file are shown to GPT
+mmap_threshold_bytes = 64 * 1024
+max_embedded_file_bytes = config.get('max_embedded_file_bytes', 1024 * 1024)
+
+def read_file_content(path):
+    size = path.stat().st_size
+    if size <= mmap_threshold_bytes:
+        with path.open('rb') as f:
+            data = f.read(max_embedded_file_bytes)
+    else:
+        with path.open('rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            data = m[:max_embedded_file_bytes]
+    text = data.decode('utf-8', errors='ignore').replace('\r\n', '\n')
+    if size > max_embedded_file_bytes:
+        text += f"\n[Truncated: only the first {max_embedded_file_bytes} of {size} bytes of this file are shown]"
+    return text
+
 def get_file_content_embeding(path):
     if not path.exists():
         return f"Error: The file {path} does not exist. Tell this to the user very briefly, telling them the path that does not exsist, ignoring the rest of the prompt."
-    with path.open() as f:
-        text = f.read()
+    text = read_file_content(path)
     return f"\n{path}>>>\n{text}\n<<<{path}\n"
 
-def search_file(start_path: Path, target_file: str) -> Optional[List[Path]]:
-    matches = list(start_path.rglob(target_file))  # Search for target file
-    if matches:
-        return matches # Returns list of all matches file paths
-    else:
-        return None
-
-def search_single_file(start_path: Path, target_file: str) -> Path:
-    matches = list(start_path.rglob(target_file))  # Search for target file
+def choose_file(matches: List[Path]) -> Optional[Path]:
     if matches:
         if len(matches) == 1:
-            return matches[0] # Returns list of all matches file paths
+            return matches[0]
         else:
-            completer = WordCompleter([str(x) for x in matches])
+            from prompt_toolkit.completion import FuzzyWordCompleter
+            completer = FuzzyWordCompleter([str(x) for x in matches])
             result = pt.prompt('Please enter your choice:', completer=completer)
             return Path(result)
     else:
         return None
 
-def explode_file_links(chat):
-    for c in chat:
-          c.update({'content': re.sub(':file:(.*):',
-                 lambda match: get_file_content_embeding(Path(match.group(1))), 
-                 c['content'])})
-    return chat
+class VaultIndex:
+    """Index from file names to paths in the obsidian vault, persisted in a JSON file.
+       The index is refreshed incrementally: only directories whose mtime changed are listed again, the others are
+       only stat'ed. Refreshes happen at most every refresh_interval seconds, or when a name is not found.
+       Hidden files and directories (like .obsidian and .trash) are not indexed.
+    """
+    def __init__(self, vault_dir, path, refresh_interval=5):
+        self.vault_dir = vault_dir
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.lock = Lock()
+        self.dirs = None
+        self.names = {}
+        self.last_refresh = 0
+
+    def _load(self):
+        self.dirs = {}
+        if self.path.exists():
+            try:
+                with self.path.open() as f:
+                    index = json.load(f)
+                if index.get('vault_dir') == str(self.vault_dir):
+                    self.dirs = index['dirs']
+            except (json.JSONDecodeError, KeyError):
+                pass
+        self._build_names()
+
+    def _save(self):
+        tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        with tmp_path.open('w') as f:
+            json.dump({'vault_dir': str(self.vault_dir), 'dirs': self.dirs}, f)
+        os.replace(tmp_path, self.path)
+
+    def _build_names(self):
+        names = {}
+        for rel_dir, (mtime_ns, subdirs, files) in self.dirs.items():
+            for name in files:
+                names.setdefault(name, []).append(os.path.join(rel_dir, name))
+        self.names = names
+
+    def refresh(self):
+        dirs = {}
+        changed = False
+        stack = ['']
+        while stack:
+            rel_dir = stack.pop()
+            full_dir = os.path.join(self.vault_dir, rel_dir)
+            try:
+                mtime_ns = os.stat(full_dir).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            entry = self.dirs.get(rel_dir)
+            if entry is None or entry[0] != mtime_ns:
+                subdirs, files = [], []
+                for e in os.scandir(full_dir):
+                    if e.name.startswith('.'):
+                        continue
+                    (subdirs if e.is_dir() else files).append(e.name)
+                entry = [mtime_ns, subdirs, files]
+                changed = True
+            dirs[rel_dir] = entry
+            stack.extend(os.path.join(rel_dir, d) for d in entry[1])
+        if changed or len(dirs) != len(self.dirs):
+            self.dirs = dirs
+            self._build_names()
+            self._save()
+        self.last_refresh = time.time()
+
+    def find(self, target_file: str) -> List[Path]:
+        """All paths of files named target_file. target_file may also include parent directories."""
+        with self.lock:
+            if self.dirs is None:
+                self._load()
+            if time.time() - self.last_refresh > self.refresh_interval:
+                self.refresh()
+            matches = self._lookup(target_file)
+            if not matches and time.time() - self.last_refresh > 0.1:
+                self.refresh()
+                matches = self._lookup(target_file)
+            return matches
+
+    def _lookup(self, target_file):
+        name = os.path.basename(target_file)
+        return [self.vault_dir / p for p in self.names.get(name, [])
+                if p == target_file or p.endswith(os.sep + target_file)]
+
+vault_index = VaultIndex(obsidian_vault_dir, config_dir / 'vault_index.json', refresh_interval=config.get('vault_index_refresh_interval', 5))
+
+file_link_pattern = re.compile(':file:(.*):')
+obsidian_link_pattern = re.compile(':obsidian:(.*):')
+
+def explode_file_links(content):
+    return file_link_pattern.sub(lambda match: get_file_content_embeding(Path(match.group(1))), content)
 
 def ensure_extension(string: str, ext: str) -> str:
     """Ensure that the text ends with a particular extension."""
@@ -361,30 +1680,449 @@ def ensure_extension(string: str, ext: str) -> str:
     return return_value
 
 
-def resolve_obsidian_links(chat):
-    for c in chat:
-          c.update({'content': re.sub(':obsidian:(.*):',
-                 lambda match: f":file:{search_single_file(obsidian_vault_dir, ensure_extension(match.group(1), '.md'))}:",
-                 c['content'])})
-    return chat
+def resolve_obsidian_links(content, resolved_paths):
+    """Replace :obsidian:NAME: links by :file:PATH: links. resolved_paths remembers the path found for each name."""
+    def resolve(match):
+        name = ensure_extension(match.group(1), '.md')
+        if name not in resolved_paths or resolved_paths[name] is None or not resolved_paths[name].exists():
+            resolved_paths[name] = choose_file(vault_index.find(name))
+        return f":file:{resolved_paths[name]}:"
+    return obsidian_link_pattern.sub(resolve, content)
+
+def file_stats(paths):
+    stats = []
+    for path in paths:
+        try:
+            stat = path.stat()
+            stats.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            stats.append(None)
+    return stats
+
+class ChatExploder:
+    """Expands the :file: and :obsidian: links of the messages of a chat, remembering the expansion of every message.
+       A message is only expanded again if its content changed, or the mtime or size of a file it references.
+       Messages without links are passed through as they are, without being copied.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.messages = {}
+        self.resolved_paths = {}
+
+    def explode(self, chat):
+        with self.lock:
+            messages = {}
+            exploded_chat = []
+            for m in chat:
+                content = m['content']
+                if ':file:' not in content and ':obsidian:' not in content:
+                    exploded_chat.append(m)
+                    continue
+                cached = self.messages.get(id(m))
+                if cached is not None and cached[0] is m and cached[1] == content and cached[3] == file_stats(cached[2]):
+                    messages[id(m)] = cached
+                    exploded_chat.append(cached[4])
+                    continue
+                resolved = resolve_obsidian_links(content, self.resolved_paths)
+                paths = [Path(p) for p in file_link_pattern.findall(resolved)]
+                stats = file_stats(paths)
+                exploded = with_content(m, explode_file_links(resolved))
+                messages[id(m)] = (m, content, paths, stats, exploded)
+                exploded_chat.append(exploded)
+            # Forget messages that are no longer part of any chat once the cache grows too large. Holding on to the
+            # messages themselves keeps their ids from being reused in the meantime.
+            if len(self.messages) + len(messages) > max(1024, 4 * len(chat)):
+                self.messages = messages
+            else:
+                self.messages.update(messages)
+        return exploded_chat
+
+chat_exploder = ChatExploder()
 
 def explode_chat(chat):
-    chat = deepcopy(chat)
-    chat = resolve_obsidian_links(chat)
-    chat = explode_file_links(chat)
-    return chat
+    return chat_exploder.explode(chat)
+
+# Completion backends. All requests for completions go through completion_backend, which can be swapped to record
+# or replay traffic, such that the whole interactive path can run offline and deterministically.
+class AttrDict(dict):
+    """Dict whose keys can also be read as attributes, like the objects returned by the openai library."""
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+def to_attr_dict(obj):
+    if isinstance(obj, dict):
+        return AttrDict({k: to_attr_dict(v) for k, v in obj.items()})
+    if isinstance(obj, list):
+        return [to_attr_dict(v) for v in obj]
+    return obj
+
+def request_key(request):
+    return content_hash(json.dumps([request.get('model'), request.get('messages')], sort_keys=True))
+
+class OpenAIBackend:
+    def create(self, **request):
+        return openai.ChatCompletion.create(**request)
+
+class RecordingBackend:
+    """Passes requests on to another backend, and appends every request together with its response as one line to
+       a JSONL file. Streamed responses are recorded chunk by chunk, with the seconds since the request was sent.
+    """
+    def __init__(self, backend, path):
+        self.backend = backend
+        self.path = path
+        self.lock = Lock()
+
+    def create(self, **request):
+        start = time.time()
+        response = self.backend.create(**request)
+        if not request.get('stream'):
+            self._write({'request': request, 'response': response, 'seconds': time.time() - start})
+            return response
+        return self._record_stream(request, response, start)
+
+    def _record_stream(self, request, response, start):
+        chunks = []
+        try:
+            for chunk in response:
+                chunks.append([time.time() - start, chunk])
+                yield chunk
+        finally:
+            self._write({'request': request, 'chunks': chunks})
+
+    def _write(self, record):
+        with self.lock, self.path.open('a') as f:
+            f.write(json.dumps(record) + '\n')
+
+class ReplayBackend:
+    """Answers requests from the recordings of a RecordingBackend. A request gets the response recorded for the
+       same model and messages if there is one, and otherwise the next recording in the file, such that load tests
+       with new prompts still get realistic responses. Chunks are streamed with their recorded timing, or with a
+       fixed delay between them.
+    """
+    def __init__(self, path, delay=None):
+        self.delay = delay
+        self.lock = Lock()
+        self.records = []
+        with path.open() as f:
+            for line in f:
+                if line.strip():
+                    self.records.append(json.loads(line))
+        if len(self.records) == 0:
+            raise ValueError(f"There are no recordings in {path}.")
+        self.by_request = {}
+        for record in self.records:
+            self.by_request.setdefault(request_key(record['request']), []).append(record)
+        self.next_record = 0
+
+    def create(self, **request):
+        with self.lock:
+            matches = self.by_request.get(request_key(request))
+            if matches:
+                record = matches[0]
+                # Replay repeated requests in the order they were recorded
+                self.by_request[request_key(request)] = matches[1:] + matches[:1]
+            else:
+                record = self.records[self.next_record % len(self.records)]
+                self.next_record += 1
+        if not request.get('stream'):
+            response = record.get('response') or self._join_chunks(record['chunks'])
+            time.sleep(self.delay if self.delay is not None else record.get('seconds', 0))
+            return to_attr_dict(response)
+        chunks = record.get('chunks') or [[record.get('seconds', 0), self._as_chunk(record['response'])]]
+        return self._replay_stream(chunks)
+
+    def _replay_stream(self, chunks):
+        start = time.time()
+        for seconds, chunk in chunks:
+            if self.delay is not None:
+                time.sleep(self.delay)
+            else:
+                time.sleep(max(start + seconds - time.time(), 0))
+            yield to_attr_dict(chunk)
+
+    def _join_chunks(self, chunks):
+        content = ''.join(c['choices'][0]['delta'].get('content') or '' for _, c in chunks if c['choices'])
+        return {'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}]}
+
+    def _as_chunk(self, response):
+        return {'choices': [{'index': 0, 'delta': response['choices'][0]['message'], 'finish_reason': 'stop'}]}
+
+def make_backend(name, path, delay=None):
+    if name == 'record':
+        return RecordingBackend(OpenAIBackend(), path)
+    elif name == 'replay':
+        return ReplayBackend(path, delay)
+    return OpenAIBackend()
 
-def get_summary(chat):
+completion_backend = OpenAIBackend()
+
+def make_requests_session():
+    """One HTTP session for all requests to the API, such that the chat stream and the background summaries share a
+       pool of keep-alive connections instead of opening new ones.
+    """
+    class PooledSession(requests.Session):
+        def close(self):
+            # openai closes its session every few minutes, which would throw away the pooled connections
+            pass
+    session = PooledSession()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=config.get('http_pool_size', 8))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def backoff_delay(attempt, base=None, cap=None):
+    """Exponential backoff with full jitter, such that clients that failed together do not retry together."""
+    base = base if base is not None else config.get('retry_base_delay', 1.0)
+    cap = cap if cap is not None else config.get('retry_max_delay', 30.0)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def is_retryable(e):
+    """Rate limits, server errors, timeouts and broken connections are worth retrying, bad requests are not."""
+    if isinstance(e, (openai.error.TryAgain, openai.error.RateLimitError, openai.error.Timeout,
+                      openai.error.APIConnectionError, openai.error.ServiceUnavailableError)):
+        return True
+    if isinstance(e, openai.error.APIError):
+        return e.http_status is None or e.http_status >= 500
+    return isinstance(e, requests.exceptions.RequestException)
+
+def create_with_retries(on_retry=None, **request):
+    """Create a completion, retrying with jittered exponential backoff.
+       on_retry(attempt, max_retries, error, delay) is called before waiting for the next attempt.
+    """
+    max_retries = config.get('max_retries', 5)
+    for attempt in itertools.count():
+        try:
+            return completion_backend.create(**request)
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise e
+            delay = backoff_delay(attempt)
+            if on_retry:
+                on_retry(attempt + 1, max_retries, e, delay)
+            time.sleep(delay)
+
+continue_instructions = 'Your last answer was cut off. Continue it exactly where it stopped, without repeating any of it.'
+
+def stream_completion(on_response=None, on_retry=None, **request):
+    """Stream the content of a completion, retrying like create_with_retries. When the stream breaks after some
+       content arrived, the retry asks the model to continue the partial answer, instead of starting over.
+       on_response is called when the first request returned its stream.
+    """
+    partial = []
+    def request_continuation(on_retry=None):
+        messages = request['messages']
+        if partial:
+            messages = messages + [{'role': 'assistant', 'content': ''.join(partial)},
+                                   {'role': 'system', 'content': continue_instructions}]
+        with profiler.span('request', model=request.get('model')):
+            return create_with_retries(on_retry=on_retry, **{**request, 'messages': messages, 'stream': True})
+    max_retries = config.get('max_retries', 5)
+    for attempt in itertools.count():
+        response = request_continuation(on_retry)
+        if attempt == 0 and on_response:
+            on_response()
+        try:
+            for chunk in response:
+                delta = chunk['choices'][0].get('delta', {}) if chunk.get('choices') else {}
+                content = delta.get('content')
+                if content:
+                    partial.append(content)
+                    yield content
+            return
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise e
+            delay = backoff_delay(attempt)
+            if on_retry:
+                on_retry(attempt + 1, max_retries, e, delay)
+            time.sleep(delay)
+
+class Racer:
+    """One of the streams of a CompletionRace, with the metrics of its own turn."""
+    def __init__(self, l_model, chat, input_tokens):
+        self.model = l_model
+        self.messages = api_messages(chat)
+        self.metrics = TurnMetrics(l_model)
+        self.metrics.input_tokens = input_tokens
+        self.content = []
+        self.cancelled = Event()
+        self.finished = False
+        self.error = None
+
+    def run(self, events, on_response=None):
+        def responded():
+            self.metrics.mark('response')
+            if on_response:
+                on_response()
+        try:
+            with contextlib.closing(stream_completion(model=self.model, messages=self.messages, on_response=responded)) as stream:
+                for c in stream:
+                    if self.cancelled.is_set():
+                        return
+                    self.metrics.mark('first_token')
+                    self.content.append(c)
+                    events.put((self, c))
+            self.finished = True
+        except Exception as e:
+            self.error = e
+        finally:
+            self.metrics.mark('end')
+            events.put((self, None))
+
+class CompletionRace:
+    """Hedged completion: the same chat is streamed from several models, or several times from one model, at once,
+       and the stream that produces a first token first wins. The others are cancelled right away, or with keep_others
+       when they finished, but at the latest deadline seconds after the first token, e.g. to compare the answers.
+       Cancelled streams are closed when their next chunk arrives.
+    """
+    def __init__(self, racers, deadline=None, keep_others=False):
+        self.racers = racers
+        self.deadline = deadline
+        self.keep_others = keep_others
+        self.winner = None
+
+    def cancel(self, racers=None):
+        for r in racers if racers is not None else self.racers:
+            r.cancelled.set()
+
+    def stream(self, on_response=None, on_winner=None):
+        """Yield the content of the winner. on_response is called whenever a request returned its stream, and
+           on_winner with the winning Racer when its first token arrived.
+        """
+        events = queue.Queue()
+        for r in self.racers:
+            Thread(target=r.run, args=(events, on_response), name=f'race {r.model}', daemon=True).start()
+        running = set(self.racers)
+        deadline = None
+        try:
+            while running:
+                try:
+                    racer, content = events.get(timeout=None if deadline is None else max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    # Only the winner is streamed to its end
+                    self.cancel(running - {self.winner})
+                    running &= {self.winner}
+                    deadline = None
+                    continue
+                if content is None:
+                    running.discard(racer)
+                    if racer is self.winner:
+                        if racer.error is not None:
+                            raise racer.error
+                        if not self.keep_others:
+                            return
+                    continue
+                if self.winner is None:
+                    self.winner = racer
+                    if not self.keep_others:
+                        self.cancel([r for r in self.racers if r is not racer])
+                    elif self.deadline is not None:
+                        deadline = time.perf_counter() + self.deadline
+                    if on_winner:
+                        on_winner(racer)
+                if racer is self.winner:
+                    yield content
+            errors = [r.error for r in self.racers if r.error is not None]
+            if self.winner is None and errors:
+                raise errors[0]
+        finally:
+            self.cancel()
+
+    def record(self, turn):
+        """Record the race in the metrics of the turn: the model that won, and the metrics of every stream."""
+        for r in self.racers:
+            r.metrics.output_tokens = count_tokens({'content': ''.join(r.content)}, r.model) if r.content else 0
+            r.metrics.outcome = 'won' if r is self.winner else 'failed' if r.error is not None else \
+                                'finished' if r.finished else 'cancelled'
+        if self.winner is not None:
+            turn.model = self.winner.model
+            turn.input_tokens = self.winner.metrics.input_tokens
+        turn.race = [r.metrics for r in self.racers]
+
+    def print_answers(self, width=None):
+        """Print the answers of all streams side by side."""
+        width = width if width else shutil.get_terminal_size().columns
+        column_width = max((width - 3 * (len(self.racers) - 1)) // len(self.racers), 10)
+        columns = []
+        for r in self.racers:
+            ttft = r.metrics.seconds('first_token')
+            header = f"{r.model} {r.metrics.outcome}" + (f" {ttft:.2f}s" if ttft is not None else '') + f" ${r.metrics.cost():.4f}"
+            lines = [line for paragraph in ''.join(r.content).splitlines() for line in (textwrap.wrap(paragraph, column_width) or [''])]
+            columns.append([header[:column_width], '-' * column_width] + lines)
+        for row in itertools.zip_longest(*columns, fillvalue=''):
+            print(' | '.join(cell.ljust(column_width) for cell in row).rstrip())
+
+race_context_indexes = {}
+
+def race_models() -> Optional[List[str]]:
+    """@return: Returns the models to race for a completion, or None if completions are not hedged."""
+    if args.hedge is None:
+        return None
+    return args.hedge if args.hedge else [model, model]
+
+def race_context_index(l_model):
+    return context_index if l_model == model else race_context_indexes.setdefault(l_model, ContextIndex())
+
+def serve_stand_in(port):
+    # Only imported here, such that other commands do not pay for it on startup
+    import http.server
+
+    class StandInHandler(http.server.BaseHTTPRequestHandler):
+        """Local stand-in for the chat completions endpoint of the OpenAI API, answering from completion_backend."""
+        def do_POST(self):
+            if not self.path.endswith('/chat/completions'):
+                self.send_error(404)
+                return
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            response = completion_backend.create(model=request.get('model'), messages=request.get('messages'), stream=request.get('stream', False))
+            if not request.get('stream'):
+                body = json.dumps(response).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            for chunk in response:
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+
+        def log_message(self, format, *log_args):
+            if args.debug:
+                super().log_message(format, *log_args)
+
+    server = http.server.ThreadingHTTPServer(('localhost', port), StandInHandler)
+    print(f"Serving recordings on http://localhost:{port}/v1, press CTRL+C to stop.")
     try:
-        exploded_chat = explode_chat(chat)
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+def get_summary(chat, previous_summary=''):
+    """Summarize a chat. If previous_summary is given, chat only needs to contain the messages after it."""
+    l_model = config.get('summary_model', 'gpt-3.5-turbo')
+    if l_model not in models_dict:
+        l_model = model
+    try:
+        messages = explode_chat(chat)
+        if previous_summary:
+            messages = [{'role': 'system', 'content': f'Summary of the earlier conversation: {previous_summary}'}] + messages
         summarize_instuctions = (
             'Please give a summary of the conversation so far in 5 words or less. You do not need to make a complete sentence. '
             'Be as brief and descriptive as possible. Ideally do not leave out any topics discussed. If there are too many '
             'topics (and only then) it is ok to write a longer than 5 words summary, but still keep it as brief as possible. '
             'Do not use the following characters in your output: "*", ":", "!", "?", "/", "\\"')
-        summary_response = openai.ChatCompletion.create(
-            model=model,
-            messages=[{k: v for k, v in y.items() if k in ['role', 'content']} for y in exploded_chat] + [{'role': 'user', 'content': summarize_instuctions}],
+        messages, _ = trim_chat(messages + [{'role': 'user', 'content': summarize_instuctions}], l_model, index=ContextIndex())
+        summary_response = create_with_retries(
+            model=l_model,
+            messages=api_messages(messages),
         )
         summary = summary_response["choices"][0].message["content"]
     # TODO make this exception more specific
@@ -393,74 +2131,554 @@ def get_summary(chat):
         print('Error: ', e)
     return summary
 
+class PrefixHashes:
+    """Hashes of all prefixes of a chat, where the hash of chat[:i + 1] is hashes[i].
+       Only messages that changed since the last update are hashed again.
+    """
+    def __init__(self):
+        self.messages = []
+        self.hashes = []
+
+    def update(self, chat):
+        n_valid = 0
+        for (m, content), c in zip(self.messages, chat):
+            if m is not c or content is not c['content']:
+                break
+            n_valid += 1
+        del self.messages[n_valid:]
+        del self.hashes[n_valid:]
+        for c in chat[n_valid:]:
+            previous = self.hashes[-1] if self.hashes else ''
+            self.messages.append((c, c['content']))
+            self.hashes.append(content_hash(previous + c['role'] + content_hash(c['content'])))
+        return self.hashes
+
+class Summarizer:
+    """Keeps a short summary of a chat up to date in the background.
+       Summaries are cached by the hash of the chat prefix they summarize. A new summary is made from the summary of
+       the longest cached prefix plus only the messages after it, using the summary_model from the config. Requests
+       are debounced, and a summary of a chat that changed in the meantime is only cached, not shown.
+    """
+    def __init__(self, debounce=1.0, on_update=None):
+        self.debounce = debounce
+        self.on_update = on_update
+        self.summary = ''
+        self.cache = {}
+        self.prefix_hashes = PrefixHashes()
+        self.lock = Lock()
+        self.worker = None
+        self.chat = None
+        self.generation = 0
+        self.requested_at = 0
+
+    def request(self, chat):
+        with self.lock:
+            self.chat = list(chat)
+            self.generation += 1
+            self.requested_at = time.time()
+            if self.worker is None:
+                self.worker = Thread(target=self._run, name='summarizer')
+                self.worker.start()
+
+    def current(self, timeout=None):
+        """Wait up to timeout seconds for a pending summary, and return the latest summary."""
+        worker = self.worker
+        if worker is not None:
+            worker.join(timeout)
+        return self.summary
+
+    def _run(self):
+        try:
+            while True:
+                time.sleep(max(self.requested_at + self.debounce - time.time(), 0))
+                with self.lock:
+                    chat, generation = self.chat, self.generation
+                try:
+                    summary = self._summarize(chat)
+                except Exception as e:
+                    print(f"\nError while summarizing the chat: {e}")
+                    summary = None
+                with self.lock:
+                    if generation != self.generation:
+                        continue
+                    self.worker = None
+                    if summary is None:
+                        return
+                    self.summary = summary
+                if self.on_update:
+                    self.on_update(summary)
+                return
+        finally:
+            # A worker that died would otherwise keep every later request from starting a new one
+            with self.lock:
+                if self.worker is current_thread():
+                    self.worker = None
+
+    @profiler.profiled('summarize')
+    def _summarize(self, chat):
+        if len(chat) == 0:
+            return ''
+        hashes = self.prefix_hashes.update(chat)
+        if hashes[-1] in self.cache:
+            return self.cache[hashes[-1]]
+        n_summarized = next((i + 1 for i in reversed(range(len(hashes) - 1)) if hashes[i] in self.cache), 0)
+        previous_summary = self.cache[hashes[n_summarized - 1]] if n_summarized else ''
+        summary = get_summary(chat[n_summarized:], previous_summary)
+        if summary:
+            self.cache[hashes[-1]] = summary
+        return summary
+
+def compress_messages(chat, previous_summary, l_model):
+    """Summarize messages in enough detail that the summary can replace them as context for the rest of the chat."""
+    try:
+        messages = explode_chat(chat)
+        if previous_summary:
+            messages = [{'role': 'system', 'content': f'Summary of the earlier conversation: {previous_summary}'}] + messages
+        compression_instructions = (
+            'Summarize the conversation so far, including the summary of the earlier conversation if there is one. '
+            'The summary will replace the conversation as context for continuing it, so keep all facts, decisions, '
+            'names, numbers and code that might matter later, but be as concise as possible.')
+        messages, _ = trim_chat(messages + [{'role': 'user', 'content': compression_instructions}], l_model, index=ContextIndex())
+        response = create_with_retries(
+            model=l_model,
+            messages=api_messages(messages),
+        )
+        return response["choices"][0].message["content"]
+    except Exception as e:
+        debug_notify(f'Error while compressing the chat: {e}')
+        return ''
+
+class ContextCompressor:
+    """Rolls the oldest messages of a chat into a summary once the chat uses more than threshold of the context
+       window, keeping about keep of the context window as the original recent messages. The chat itself is not
+       changed, only the view that is sent to the model. Compressions run in the background after a turn and are
+       cached by the hash of the chat prefix they replace, and compressed_view only uses compressions that are
+       already done, so compressing never adds latency to a turn.
+    """
+    def __init__(self, threshold=0.8, keep=0.5):
+        self.threshold = threshold
+        self.keep = keep
+        self.lock = Lock()
+        self.worker = None
+        self.compressions = {}
+        self.view_prefix_hashes = PrefixHashes()
+        self.worker_prefix_hashes = PrefixHashes()
+        self.worker_context_index = ContextIndex()
+
+    def _n_compressed(self, hashes):
+        """@return: Returns the length of the longest prefix of the chat that has a compression."""
+        with self.lock:
+            return next((i + 1 for i in reversed(range(len(hashes))) if hashes[i] in self.compressions), 0)
+
+    def compressed_view(self, chat):
+        return self._view(chat, self.view_prefix_hashes)
+
+    def _view(self, chat, prefix_hashes):
+        hashes = prefix_hashes.update(chat)
+        n_compressed = self._n_compressed(hashes)
+        n_head = 1 if chat and chat[0]['role'] == 'system' else 0
+        if n_compressed <= n_head:
+            return chat
+        summary = self.compressions[hashes[n_compressed - 1]]
+        return chat[:n_head] + [{'role': 'system', 'content': f'Summary of the earlier conversation: {summary}'}] + chat[n_compressed:]
+
+    def prepare(self, chat, l_model=None):
+        """Start compressing in the background if the chat is getting close to the context window of l_model."""
+        l_model = l_model if l_model else model
+        if self.worker is None or not self.worker.is_alive():
+            self.worker = Thread(target=self._compress, args=[list(chat), l_model], name='context-compressor')
+            self.worker.start()
+
+    @profiler.profiled('context compression')
+    def _compress(self, chat, l_model):
+        context_window = models_dict[l_model]['max_tokens'] - reserved_completion_tokens(l_model)
+        if len(chat) == 0 or number_of_tokens(explode_chat(self._view(chat, self.worker_prefix_hashes)), l_model) < self.threshold * context_window:
+            return
+        hashes = self.worker_prefix_hashes.update(chat)
+        prefix_sums = self.worker_context_index.update(explode_chat(chat), l_model)
+        n_head = 1 if chat[0]['role'] == 'system' else 0
+        # Compress everything up to the point from which the remaining messages fill keep of the context window
+        n_compress = bisect.bisect_left(prefix_sums, prefix_sums[-1] - self.keep * context_window, lo=n_head, hi=len(chat))
+        n_compressed = max(self._n_compressed(hashes[:n_compress]), n_head)
+        compression_model = config.get('compression_model', config.get('summary_model', 'gpt-3.5-turbo'))
+        if compression_model not in models_dict:
+            compression_model = l_model
+        chunk_budget = models_dict[compression_model]['max_tokens'] // 2
+        # Compress in chunks that fit into the compression model, building each summary on the previous one
+        while n_compressed < n_compress:
+            previous_summary = self.compressions.get(hashes[n_compressed - 1], '') if n_compressed > n_head else ''
+            n_chunk_end = bisect.bisect_right(prefix_sums, prefix_sums[n_compressed] + chunk_budget, lo=n_compressed + 1, hi=n_compress + 1) - 1
+            n_chunk_end = max(n_chunk_end, n_compressed + 1)
+            summary = compress_messages(chat[n_compressed:n_chunk_end], previous_summary, compression_model)
+            if not summary:
+                return
+            with self.lock:
+                self.compressions[hashes[n_chunk_end - 1]] = summary
+            n_compressed = n_chunk_end
+
+context_compressor = ContextCompressor(
+    threshold=config.get('compression_threshold', 0.8),
+    keep=config.get('compression_keep', 0.5))
+
+class TurnMetrics:
+    """Timestamps and token counts of one assistant turn. The phases are marked as 'response' when the request
+       returned the stream, 'first_token', 'end' when the stream is done and 'first_audio' when speech started.
+    """
+    def __init__(self, l_model, awaiting_audio=False):
+        self.model = l_model
+        self.date = timestamp()
+        self.times = {'start': time.perf_counter()}
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.awaiting_audio = awaiting_audio
+        # For hedged turns, the metrics of every stream of the race, and how each of them ended
+        self.race = []
+        self.outcome = None
+
+    def mark(self, event):
+        # Only the first occurrence counts, e.g. of the first token
+        self.times.setdefault(event, time.perf_counter())
+
+    def seconds(self, event, since='start') -> Optional[float]:
+        if event not in self.times or since not in self.times:
+            return None
+        return round(self.times[event] - self.times[since], 4)
+
+    def cost(self):
+        metadata = models_dict.get(self.model, {})
+        return self.input_tokens * metadata.get('cost_per_input_token', 0) + self.output_tokens * metadata.get('cost_per_output_token', 0)
+
+    def tokens_per_second(self) -> Optional[float]:
+        streaming_seconds = self.seconds('end', since='first_token')
+        return round(self.output_tokens / streaming_seconds, 2) if streaming_seconds else None
+
+    def to_dict(self):
+        return {'date': self.date, 'model': self.model,
+                'request_setup_seconds': self.seconds('response'),
+                'time_to_first_token_seconds': self.seconds('first_token'),
+                'streaming_seconds': self.seconds('end', since='first_token'),
+                'total_seconds': self.seconds('end'),
+                'first_audio_seconds': self.seconds('first_audio'),
+                'input_tokens': self.input_tokens, 'output_tokens': self.output_tokens,
+                'tokens_per_second': self.tokens_per_second(), 'cost': self.cost(),
+                **({'outcome': self.outcome} if self.outcome else {}),
+                **({'race': [r.to_dict() for r in self.race]} if self.race else {})}
+
+    def race_cost(self):
+        """@return: Returns the cost of the streams of a hedged turn that did not win."""
+        return sum(r.cost() for r in self.race if r.outcome != 'won')
+
+class Telemetry:
+    """Per turn latency, throughput and cost. Turns are appended to a JSONL file once they are complete, which for
+       spoken turns is when the first audio started playing, or at the latest when the next turn starts. The totals
+       of the session are optionally written in the Prometheus textfile collector format.
+    """
+    def __init__(self, path, prometheus_path=None):
+        self.path = path
+        self.prometheus_path = prometheus_path
+        self.lock = Lock()
+        self.unwritten = []
+        self.last_turn = None
+        self.session_cost = 0.0
+        self.totals = {}
+
+    def start_turn(self, l_model, speak=False) -> TurnMetrics:
+        self.flush()
+        return TurnMetrics(l_model, awaiting_audio=speak)
+
+    def end_turn(self, turn):
+        turn.mark('end')
+        with self.lock:
+            self.last_turn = turn
+            self.session_cost += turn.cost() + turn.race_cost()
+            for t in [turn] + [r for r in turn.race if r.outcome != 'won']:
+                totals = self.totals.setdefault(t.model, {'turns': 0, 'races_won': 0, 'input_tokens': 0, 'output_tokens': 0, 'cost': 0.0})
+                if t is turn:
+                    totals['turns'] += 1
+                    totals['races_won'] += 1 if turn.race else 0
+                totals['input_tokens'] += t.input_tokens
+                totals['output_tokens'] += t.output_tokens
+                totals['cost'] += t.cost()
+            self.unwritten.append(turn)
+        self._write_prometheus(turn)
+        if not turn.awaiting_audio:
+            self.flush()
+
+    def first_audio(self, turn):
+        turn.mark('first_audio')
+        turn.awaiting_audio = False
+        self.flush()
+
+    def flush(self):
+        """Write all ended turns, also those that still wait for audio. Failing to write them never fails a turn."""
+        with self.lock:
+            turns, self.unwritten = self.unwritten, []
+            if len(turns) == 0:
+                return
+            try:
+                with self.path.open('a') as f:
+                    for turn in turns:
+                        f.write(json.dumps(turn.to_dict()) + '\n')
+            except OSError as e:
+                print(f"\nError while writing metrics: {e}", file=sys.stderr)
+
+    def _write_prometheus(self, last_turn):
+        if self.prometheus_path is None:
+            return
+        lines = []
+        def metric(name, kind, description, values):
+            lines.append(f'# HELP gpt_ui_{name} {description}')
+            lines.append(f'# TYPE gpt_ui_{name} {kind}')
+            for l_model, value in values:
+                lines.append(f'gpt_ui_{name}{{model="{l_model}"}} {value}')
+        with self.lock:
+            totals = list(self.totals.items())
+            metric('turns_total', 'counter', 'Assistant turns in this session.', [(m, t['turns']) for m, t in totals])
+            metric('races_won_total', 'counter', 'Hedged turns that were won by the model in this session.', [(m, t['races_won']) for m, t in totals])
+            metric('input_tokens_total', 'counter', 'Prompt tokens sent in this session.', [(m, t['input_tokens']) for m, t in totals])
+            metric('output_tokens_total', 'counter', 'Completion tokens received in this session.', [(m, t['output_tokens']) for m, t in totals])
+            metric('cost_dollars_total', 'counter', 'Cost of this session in dollars.', [(m, t['cost']) for m, t in totals])
+            for name, value, description in [
+                    ('time_to_first_token_seconds', last_turn.seconds('first_token'), 'Time to first token of the last turn.'),
+                    ('tokens_per_second', last_turn.tokens_per_second(), 'Streaming throughput of the last turn.')]:
+                if value is not None:
+                    metric(name, 'gauge', description, [(last_turn.model, value)])
+            # Write atomically, such that the collector never reads a partial file. Batch workers end their turns
+            # concurrently, and would otherwise replace each other's temporary file.
+            tmp_path = self.prometheus_path.with_name(f".{self.prometheus_path.name}.tmp")
+            try:
+                tmp_path.write_text('\n'.join(lines) + '\n')
+                os.replace(tmp_path, self.prometheus_path)
+            except OSError as e:
+                print(f"\nError while writing metrics: {e}", file=sys.stderr)
+
+telemetry = Telemetry(
+    Path(config.get('metrics_file', project_dir / 'metrics.jsonl')).expanduser(),
+    prometheus_path=Path(config['prometheus_textfile']).expanduser() if config.get('prometheus_textfile') else None)
+atexit.register(telemetry.flush)
+
 class Toolbar:
     def __init__(self):
         self.n_tokens = 0
-        self.summary = ''
         self.worker = None
+        self.summarizer = Summarizer(debounce=config.get('summary_debounce', 1.0), on_update=self._update_summary)
+
+    @property
+    def summary(self):
+        return self.summarizer.summary
 
     def __str__(self):
-        return f'{model} | {int(self.n_tokens/max_tokens*100)}% {self.n_tokens}/{max_tokens} | {args.personality} | {self.summary}'
+        metrics = f' | ${telemetry.session_cost:.4f}'
+        if telemetry.last_turn is not None and telemetry.last_turn.tokens_per_second() is not None:
+            metrics += f' {telemetry.last_turn.tokens_per_second():.1f} tok/s'
+        branch = f' | branch {chat_tree.active}' if chat_tree.chats else ''
+        return f'{model} | {int(self.n_tokens/max_tokens*100)}% {self.n_tokens}/{max_tokens}{metrics} | {args.personality}{branch} | {self.summary}'
 
     def background_update(self, chat):
+        self.summarizer.request(chat)
         if self.worker is None or not self.worker.is_alive():
-            t = Thread(target=self._update, args=[chat])
+            t = Thread(target=self._update_num_tokens, args=[chat], name='toolbar')
             self.worker = t
             t.start()
 
-    def _update(self, chat):
-        self._update_num_tokens(chat)
-        self._update_summary(chat)
-
+    @profiler.profiled('toolbar tokens')
     def _update_num_tokens(self, chat):
         self.n_tokens = number_of_tokens(explode_chat(chat))
 
-    def _update_summary(self, chat):
-        self.summary = get_summary(chat)
-        set_terminal_title(f"GPT {self.summary}")
+    def _update_summary(self, summary):
+        set_terminal_title(f"GPT {summary}")
 
 bottom_toolbar_session = Toolbar()
 
+class SpeechCache:
+    """Content addressed cache of synthesized speech. Audio files are named by a hash of the text, voice command,
+       synthesis speed and format, so repeated text is never synthesized twice. Files older than max_age_days are
+       evicted, and then the least recently used ones until the cache is smaller than max_bytes.
+       The size of the cache is kept track of, such that the directory is only scanned when the cache grew too big,
+       and every scan_interval seconds for the files that got too old.
+    """
+    scan_interval = 60 * 60
+
+    def __init__(self, directory, max_bytes, max_age_days):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.lock = Lock()
+        self.total_bytes = None
+        self.last_scan = 0
+        self.hits = 0
+        self.misses = 0
+        self.synthesis_seconds = 0.0
+
+    def path(self, cmd, text, speed, extension) -> Path:
+        key = hashlib.sha256(json.dumps([text, cmd, speed, extension]).encode('utf-8')).hexdigest()
+        return self.directory / f"{key}{extension}"
+
+    def lookup(self, path) -> bool:
+        with self.lock:
+            try:
+                # Touch the file, such that eviction sees it as recently used
+                os.utime(path)
+            except FileNotFoundError:
+                self.misses += 1
+                return False
+            self.hits += 1
+            return True
+
+    def add(self, path, synthesis_seconds):
+        with self.lock:
+            self.synthesis_seconds += synthesis_seconds
+            if self.total_bytes is not None:
+                try:
+                    self.total_bytes += path.stat().st_size
+                except FileNotFoundError:
+                    pass
+            if self.total_bytes is None or self.total_bytes > self.max_bytes or time.time() - self.last_scan > self.scan_interval:
+                self._evict()
+
+    def _evict(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        min_mtime = time.time() - self.max_age_days * 24 * 60 * 60
+        for mtime, size, path in files:
+            if mtime >= min_mtime and total <= self.max_bytes:
+                break
+            Path(path).unlink(missing_ok=True)
+            total -= size
+        self.total_bytes = total
+        self.last_scan = time.time()
+
+    def stats(self):
+        average_synthesis_seconds = self.synthesis_seconds / self.misses if self.misses else 0
+        return {'hits': self.hits, 'misses': self.misses, 'synthesis_seconds': round(self.synthesis_seconds, 2),
+                'saved_seconds': round(self.hits * average_synthesis_seconds, 2)}
+
+speech_cache = SpeechCache(
+    voice_precache_dir,
+    max_bytes=config.get('tts_cache_max_mb', 500) * 1024 * 1024,
+    max_age_days=config.get('tts_cache_max_age_days', 30))
+
 class Speaker:
-    def __init__(self):
-        self.arg_queue = []
-        self.queue_processor = None
-        self.stop_flag = False
+    """Speech pipeline. Text is synthesized by a bounded pool of workers, at most prefetch sentences ahead of
+       playback, while a separate thread plays the audio back in order. Playback speeds up when a backlog of
+       text builds up. on_first_audio is called when the first audio starts playing.
+    """
+    def __init__(self, workers=None, prefetch=None, on_first_audio=None):
+        self.workers = workers if workers else config.get('tts_workers', 2)
+        self.prefetch = prefetch if prefetch else config.get('tts_prefetch', 3)
+        self.text_queue = queue.Queue()
+        self.synthesis_pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='speaker-synthesis')
+        self.playback_thread = None
+        self.lock = Lock()
+        self.stop_event = Event()
+        self.synthesis_subprocesses = set()
         self.speak_subprocess = None
+        self.backlog_chars = 0
+        self.on_first_audio = on_first_audio
 
     def stop(self):
-        self.stop_flag = True
-        if self.speak_subprocess is not None:
-            self.speak_subprocess.kill()
-        self.arg_queue = []
+        """Stop playback and cancel all queued and in-flight synthesis. Later calls to speak are ignored."""
+        self.stop_event.set()
+        with self.lock:
+            while not self.text_queue.empty():
+                self.text_queue.get_nowait()
+            for proc in self.synthesis_subprocesses:
+                proc.kill()
+            if self.speak_subprocess is not None:
+                self.speak_subprocess.kill()
+        self.synthesis_pool.shutdown(wait=False, cancel_futures=True)
 
     def speak(self, cmd, text) -> None:
         text = self._prepare_text(text)
         text = text.strip()
-        if text == "":
+        if text == "" or self.stop_event.is_set():
             return
-        speak_touple = self._precompute_speech(cmd, text)
-        self.arg_queue.append(speak_touple)
-        if self.queue_processor is None or not self.queue_processor.is_alive():
-            tp = Thread(target=self._process_queue)
-            self.queue_processor = tp
-            tp.start()
-
-    def _process_queue(self):
-        while len(self.arg_queue) > 0 and not self.stop_flag:
-            t = Thread(target=self._speak)
-            t.start()
-            t.join()
-
-    def _precompute_speech(self, cmd, text) -> Tuple[subprocess.Popen, Path]:
+        with self.lock:
+            self.text_queue.put((cmd, text))
+            self.backlog_chars += len(text)
+            if self.playback_thread is None:
+                self.playback_thread = Thread(target=self._playback, name='speaker-playback')
+                self.playback_thread.start()
+
+    def playback_speed(self):
+        base_speed = config.get('tts_playback_speed', 1.4)
+        return min(base_speed + self.backlog_chars * config.get('tts_speedup_per_char', 0.0002),
+                   config.get('tts_max_playback_speed', 1.8))
+
+    def _playback(self):
+        pending = deque()
+        try:
+            while not self.stop_event.is_set():
+                # Keep up to prefetch sentences in synthesis while we play
+                while len(pending) < self.prefetch:
+                    try:
+                        cmd, text = self.text_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    pending.append((text, self.synthesis_pool.submit(self._synthesize, cmd, text)))
+                if len(pending) == 0:
+                    with self.lock:
+                        if self.text_queue.empty():
+                            self.playback_thread = None
+                            return
+                    continue
+                text, future = pending.popleft()
+                try:
+                    with profiler.span('speech wait'):
+                        audio_file = future.result()
+                except CancelledError:
+                    break
+                except OSError as e:
+                    print(f"\nError while synthesizing speech: {e}")
+                    audio_file = None
+                with self.lock:
+                    self.backlog_chars -= len(text)
+                if audio_file is not None:
+                    try:
+                        self._play(audio_file)
+                    except (OSError, subprocess.SubprocessError) as e:
+                        print(f"\nError while playing speech: {e}")
+        finally:
+            for text, future in pending:
+                future.cancel()
+            # A thread that ran out of text cleared this already, and speak may have started the next one since
+            with self.lock:
+                if self.playback_thread is current_thread():
+                    self.playback_thread = None
+
+    @profiler.profiled('speech synthesis')
+    def _synthesize(self, cmd, text) -> Optional[Path]:
         if cmd == "say" and platform.system() == "Darwin":
             extension = ".aiff"
         else:
             extension = ".mp3"
-        cache_file = voice_precache_dir / f"{timestamp()}{extension}"
+        speed = config.get('tts_synthesis_speed', 1)
+        cache_file = speech_cache.path(cmd, text, speed, extension)
+        if speech_cache.lookup(cache_file):
+            return cache_file
+        # Synthesize into a temporary file, such that the cache never contains partial audio
+        partial_file = cache_file.with_name(f".{timestamp()}-{cache_file.name}")
         debug_notify(text)
-        proc = subprocess.Popen([cmd, "--output-file", cache_file, "--speed", str(1), "--", text], stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        return proc, Path(cache_file), text
+        start = time.time()
+        with self.lock:
+            if self.stop_event.is_set():
+                return None
+            proc = subprocess.Popen([cmd, "--output-file", partial_file, "--speed", str(speed), "--", text], stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.synthesis_subprocesses.add(proc)
+        proc.wait()
+        with self.lock:
+            self.synthesis_subprocesses.discard(proc)
+        if proc.returncode != 0 or not partial_file.exists():
+            partial_file.unlink(missing_ok=True)
+            return None
+        os.replace(partial_file, cache_file)
+        speech_cache.add(cache_file, time.time() - start)
+        return cache_file
 
     def _prepare_text(self, reading_buffer):
         reading_buffer = re.sub('`', '', reading_buffer)
@@ -472,14 +2690,16 @@ class Speaker:
         reading_buffer = reading_buffer.strip()
         return reading_buffer
 
-    def _speak(self):
-        proc, cache_file, text = self.arg_queue.pop(0)
-        proc.wait()
-        mpv_speed = 1.4 #min(sum([len(s[2]) for s in self.arg_queue]) * 0.0001  + 1, 1.1)
-        if cache_file.exists():
-            self.speak_subprocess = subprocess.Popen(["mpv", "--really-quiet", f"--speed={mpv_speed}", cache_file], stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-            self.speak_subprocess.wait()
-            cache_file.unlink()
+    @profiler.profiled('speech playback')
+    def _play(self, audio_file):
+        with self.lock:
+            if self.stop_event.is_set():
+                return
+            if self.on_first_audio is not None:
+                self.on_first_audio()
+                self.on_first_audio = None
+            self.speak_subprocess = subprocess.Popen(["mpv", "--really-quiet", f"--speed={self.playback_speed():.2f}", audio_file], stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.speak_subprocess.wait()
 
 
 def get_first_sentence(text: str) -> Tuple[str, str]:
@@ -503,8 +2723,99 @@ def get_first_sentence(text: str) -> Tuple[str, str]:
             break
     return first_sentence, remaining_text
 
+class SentenceSegmenter:
+    """Split streamed text into sentences for speech, scanning only the newly arrived characters.
+       Like get_first_sentence, a sentence ends at a newline or at an end character followed by whitespace or a
+       quote, but not after common abbreviations, initials and the numbers of numbered lists. Inside markdown code
+       fences only newlines end a sentence, and the fence lines themselves are not spoken. After the first
+       sentence, which is emitted right away such that speech starts early, sentences are batched until they are
+       at least min_batch_chars long.
+       The streamed chunks of a sentence are kept in a list, and only joined when a chunk arrives that may end it.
+    """
+    end_chars = '.?!:。？！'
+    abbreviations = {'e.g', 'i.e', 'etc', 'vs', 'cf', 'approx', 'mr', 'mrs', 'ms', 'dr', 'prof', 'st', 'no', 'fig'}
+
+    def __init__(self, min_batch_chars=80):
+        self.min_batch_chars = min_batch_chars
+        self.parts = []
+        self.length = 0
+        self.buffer = ''
+        self.pos = 0
+        self.sentence_start = 0
+        self.line_start = 0
+        self.in_code = False
+        self.batch = []
+        self.batch_length = 0
+        self.n_batches = 0
+
+    def feed(self, text) -> List[str]:
+        """Add streamed text. @return: Returns the batches of sentences that are ready to be spoken."""
+        self.parts.append(text)
+        self.length += len(text)
+        if self.pos + len(text) == self.length and not any(c in text for c in self.end_chars + '\n'):
+            self.pos = self.length
+            return []
+        ready = []
+        buffer = self.buffer = ''.join(self.parts)
+        i = self.pos
+        while i < len(buffer):
+            c = buffer[i]
+            if c == '\n':
+                if buffer[self.line_start:i].lstrip().startswith('```'):
+                    self.in_code = not self.in_code
+                    self.sentence_start = i + 1
+                else:
+                    self._end_sentence(i + 1, ready)
+                self.line_start = i + 1
+            elif c in self.end_chars and not self.in_code:
+                if i + 1 == len(buffer):
+                    # We need to see the next character to decide
+                    break
+                # Punctuation followed by a newline is left to the newline, and closing quotes stay with the sentence
+                if buffer[i + 1] in ' "\'' and not self._is_abbreviation_or_number(i):
+                    self._end_sentence(i + 1 if buffer[i + 1] == ' ' else i + 2, ready)
+            i += 1
+        self.pos = i
+        # Drop the consumed text, such that the buffer does not grow with the length of the reply
+        if self.sentence_start > 0:
+            self.buffer = buffer[self.sentence_start:]
+            self.pos -= self.sentence_start
+            self.line_start = max(self.line_start - self.sentence_start, 0)
+            self.sentence_start = 0
+        self.parts = [self.buffer]
+        self.length = len(self.buffer)
+        return ready
+
+    def flush(self) -> str:
+        """@return: Returns everything that was not emitted yet, and resets the segmenter."""
+        text = ''.join(self.batch) + ('' if self.in_code else ''.join(self.parts)[self.sentence_start:])
+        self.__init__(self.min_batch_chars)
+        return text
+
+    def _is_abbreviation_or_number(self, i):
+        if self.buffer[i] != '.':
+            return False
+        word_start = max(self.buffer.rfind(' ', 0, i), self.buffer.rfind('\n', 0, i)) + 1
+        word = self.buffer[word_start:i].lower()
+        if word in self.abbreviations or (len(word) == 1 and word.isalpha()):
+            return True
+        return word.isdigit() and self.buffer[self.line_start:word_start].strip() == ''
+
+    def _end_sentence(self, end, ready):
+        sentence = self.buffer[self.sentence_start:end]
+        self.sentence_start = end
+        if sentence.strip() == '':
+            return
+        self.batch.append(sentence)
+        self.batch_length += len(sentence)
+        if self.n_batches == 0 or self.batch_length >= self.min_batch_chars:
+            ready.append(''.join(self.batch))
+            self.batch = []
+            self.batch_length = 0
+            self.n_batches += 1
+
 def chat_to_markdown(chat):
-    markdown = '%% Auto geneterated file, do not edit %%\n\n'
+    parts = ['%% Auto geneterated file, do not edit %%\n\n']
     for m in chat:
         if m['role'] == 'assistant':
             speaker = m.get('model', 'assistant')
@@ -512,12 +2823,64 @@ def chat_to_markdown(chat):
             speaker = m.get('user', 'user')
         else:
             speaker = m['role']
-        markdown += f"**{speaker}:** {m['content']}\n"
-    return markdown
+        parts.append(f"**{speaker}:** {m['content']}\n")
+    return ''.join(parts)
+
+def save_chat_as_markdown(chat, name) -> bool:
+    """Write a chat as markdown into the chat directory, unless the file already has the same content, such that
+       synced vaults do not see changes that are none. A file with the same content is only touched, such that it is
+       newer than its chat again.
+       @return: Returns whether the file was written.
+    """
+    path = chat_dir / f"{name}.md"
+    markdown = chat_to_markdown(chat)
+    try:
+        if path.read_text() == markdown:
+            os.utime(path)
+            return False
+    except FileNotFoundError:
+        pass
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.write_text(markdown)
+    os.replace(tmp_path, path)
+    return True
+
+# Below this many chats to export, starting worker processes takes longer than the export
+export_pool_threshold = 32
+
+def export_chat_to_markdown(chat_file):
+    """@return: Returns a touple of (chat_file, whether the markdown file was written, error message or None)"""
+    try:
+        chat = read_chat_file(chat_file)
+        return chat_file, save_chat_as_markdown(chat, chat_file.stem), None
+    except Exception as e:
+        return chat_file, False, str(e)
 
-def save_chat_as_markdown(chat, name):
-    with (chat_dir / f"{name}.md").open("w") as f:
-        f.write(chat_to_markdown(chat))
+def export_chats_to_markdown(workers=None):
+    """Export the named chats whose JSON file is newer than their markdown file, in a pool of processes.
+       @return: Returns the number of markdown files that were written.
+    """
+    stale = []
+    for entry in os.scandir(chat_dir):
+        if entry.name.startswith('.') or not entry.name.endswith('.json') or not entry.is_file():
+            continue
+        try:
+            if (chat_dir / f"{entry.name[:-len('.json')]}.md").stat().st_mtime_ns >= entry.stat().st_mtime_ns:
+                continue
+        except FileNotFoundError:
+            pass
+        stale.append(Path(entry.path))
+    if len(stale) < export_pool_threshold:
+        results = map(export_chat_to_markdown, stale)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(export_chat_to_markdown, stale, chunksize=16))
+    n_written = 0
+    for chat_file, written, error in results:
+        if error is not None:
+            print(f"Error while exporting chat {chat_file}: {error}")
+        n_written += written
+    return n_written
 
 def sanetize_filename(filename):
     """Sanetize a filename to be safe to use on most filesystems, as well as work with the Obsidian sync plugin."""
@@ -525,14 +2888,186 @@ def sanetize_filename(filename):
     filename = re.sub('[<>"/\|?*]+', '', filename)
     filename = re.sub('\.^', '', filename)
     return filename.strip()
-    
+
+class RateLimiter:
+    """Token buckets for the requests and tokens per minute of a model. Requests wait until both buckets have room.
+       Tokens a request turns out to use beyond those acquired up front are charged afterwards, which may put the
+       bucket into debt that later requests wait for.
+    """
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.requests = requests_per_minute or 0
+        self.tokens = tokens_per_minute or 0
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self, tokens=0):
+        while True:
+            with self.lock:
+                self._refill()
+                wait = 0
+                if self.requests_per_minute and self.requests < 1:
+                    wait = (1 - self.requests) * 60 / self.requests_per_minute
+                if self.tokens_per_minute:
+                    # A request larger than the whole bucket only waits for a full bucket
+                    needed = min(tokens, self.tokens_per_minute)
+                    if self.tokens < needed:
+                        wait = max(wait, (needed - self.tokens) * 60 / self.tokens_per_minute)
+                if wait == 0:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+            time.sleep(wait)
+
+    def charge(self, tokens):
+        with self.lock:
+            self._refill()
+            self.tokens -= tokens
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed, self.updated = now - self.updated, now
+        if self.requests_per_minute:
+            self.requests = min(self.requests + elapsed * self.requests_per_minute / 60, self.requests_per_minute)
+        if self.tokens_per_minute:
+            self.tokens = min(self.tokens + elapsed * self.tokens_per_minute / 60, self.tokens_per_minute)
+
+rate_limiters = {}
+rate_limiters_lock = Lock()
+
+def rate_limiter(l_model):
+    """@return: Returns the shared RateLimiter of a model, with the limits of the config or the model metadata."""
+    with rate_limiters_lock:
+        if l_model not in rate_limiters:
+            metadata = models_dict.get(l_model, {})
+            limits = config.get('rate_limits', {}).get(l_model, {})
+            rate_limiters[l_model] = RateLimiter(
+                limits.get('requests_per_minute', metadata.get('requests_per_minute')),
+                limits.get('tokens_per_minute', metadata.get('tokens_per_minute')))
+        return rate_limiters[l_model]
+
+def resolve_model(name):
+    """@return: Returns the name of the model with the name or alias, or name if no model has it."""
+    for n_model in models_dict.values():
+        if name == n_model['name'] or name in n_model['aliases']:
+            return n_model['name']
+    return name
+
+# Expanding links may prompt to choose between files, so batch workers take turns
+batch_explode_lock = Lock()
+
+def complete_batch_prompt(item, max_retries=5):
+    """Answer one prompt of a batch without streaming, waiting for the rate limits of its model.
+       @return: Returns the result record, without the id of the prompt.
+    """
+    l_model = resolve_model(item.get('model', model))
+    chat = personality_chat(item.get('personality', args.personality))
+    chat.append(Message(role='user', content=item['prompt'], user=user))
+    with batch_explode_lock:
+        exploded_chat = explode_chat(chat)
+    exploded_chat, num_tokens = trim_chat(exploded_chat, l_model, index=ContextIndex())
+    limiter = rate_limiter(l_model)
+    turn = TurnMetrics(l_model)
+    for attempt in itertools.count():
+        limiter.acquire(num_tokens)
+        try:
+            response = completion_backend.create(
+                model=l_model,
+                messages=api_messages(exploded_chat))
+            break
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise e
+            time.sleep(backoff_delay(attempt))
+    turn.mark('response')
+    content = response['choices'][0]['message']['content']
+    usage = response.get('usage') or {}
+    turn.input_tokens = usage.get('prompt_tokens', num_tokens)
+    turn.output_tokens = usage.get('completion_tokens', len(get_tokenizer(l_model).encode(content, disallowed_special=())))
+    limiter.charge(turn.output_tokens + turn.input_tokens - num_tokens)
+    telemetry.end_turn(turn)
+    return {'model': l_model, 'response': content, 'input_tokens': turn.input_tokens,
+            'output_tokens': turn.output_tokens, 'cost': turn.cost(), 'attempts': attempt + 1,
+            'seconds': turn.seconds('end')}
+
+def completed_batch_ids(output_path):
+    """@return: Returns the ids of the prompts that have a successful result in output_path."""
+    ids = set()
+    if output_path is None or not output_path.exists():
+        return ids
+    with output_path.open() as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line of an interrupted batch may be cut off
+                continue
+            if 'error' not in result:
+                ids.add(json.dumps(result['id']))
+    return ids
+
+def run_batch(input_file, output_file, workers, order='input', max_retries=5):
+    """Answer all prompts of a JSONL file concurrently, and append one JSON result per line to output_file.
+       Prompts without an id are identified by their line number. Prompts with a successful result in output_file
+       are skipped, such that an interrupted batch can be resumed by running it again, and failed ones are retried.
+       @return: Returns the number of failed prompts.
+    """
+    with (sys.stdin if input_file == '-' else open(input_file)) as f:
+        items = [json.loads(line) for line in f if line.strip()]
+    for i, item in enumerate(items):
+        item.setdefault('id', i)
+    output_path = None if output_file == '-' else Path(output_file)
+    completed = completed_batch_ids(output_path)
+    pending = [item for item in items if json.dumps(item['id']) not in completed]
+
+    def complete(item):
+        try:
+            return {'id': item['id'], **complete_batch_prompt(item, max_retries)}
+        except Exception as e:
+            return {'id': item['id'], 'error': f"{type(e).__name__}: {e}"}
+
+    if output_path is None:
+        output = contextlib.nullcontext(sys.stdout)
+    else:
+        # Start on a new line, in case the last run was interrupted in the middle of one
+        if output_path.exists() and output_path.stat().st_size > 0 and not output_path.read_bytes().endswith(b'\n'):
+            with output_path.open('a') as f:
+                f.write('\n')
+        output = output_path.open('a')
+    n_failed = 0
+    cost = 0.0
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch')
+    try:
+        with output as out:
+            futures = [pool.submit(complete, item) for item in pending]
+            for future in (futures if order == 'input' else as_completed(futures)):
+                result = future.result()
+                out.write(json.dumps(result) + '\n')
+                out.flush()
+                n_failed += 'error' in result
+                cost += result.get('cost', 0)
+    except KeyboardInterrupt:
+        pool.shutdown(wait=False, cancel_futures=True)
+        print("Batch interrupted. Run it again with the same output to resume.", file=sys.stderr)
+        raise
+    pool.shutdown()
+    print(f"{len(pending) - n_failed} answered, {n_failed} failed, {len(items) - len(pending)} already answered, "
+          f"cost ${cost:.4f}", file=sys.stderr)
+    return n_failed
+
 def main():
     speak_cmd = 'gsay'
-    save_name_session = PromptSession(history=FileHistory(prompt_history_dir /'saveing.txt'), auto_suggest=AutoSuggestFromHistory())
-    user_prompt_session = PromptSession(history=FileHistory(project_dir /'user_prompt.txt'), auto_suggest=AutoSuggestFromHistory())
     def bottom_toolbar():
         return str(bottom_toolbar_session)
-    
+
+    global completion_backend
+    completion_backend = make_backend(args.backend, args.backend_file, args.replay_delay)
+    if args.serve_replay:
+        completion_backend = ReplayBackend(args.backend_file, args.replay_delay)
+        serve_stand_in(args.serve_replay)
+        exit(0)
+
     if args.list_models_full:
         for m in sorted(openai.Model.list()['data'], key=lambda x: x['id']): 
             print(m)
@@ -546,6 +3081,14 @@ def main():
 
     chat_name = args.chat_name
 
+    if args.hedge:
+        # Models can be given by their aliases, like everywhere else
+        args.hedge = [resolve_model(m) for m in args.hedge]
+    unknown_models = [m for m in args.hedge or [] if m not in models_dict]
+    if unknown_models:
+        print(f"Unknown models to hedge with: {', '.join(unknown_models)}")
+        exit(1)
+
     if args.list_chats:
         list_chats()
         exit(0)
@@ -555,27 +3098,41 @@ def main():
     elif args.config:
         subprocess.run([os.environ['EDITOR'], config_file])
         exit(0)
+    if args.gc_chats:
+        n_backups, n_moved, n_messages, reclaimed = gc_chats()
+        print(f"Deleted {n_backups} backups and {n_messages} unreferenced messages, moved {n_moved} chats into the message store.")
+        print(f"Reclaimed {reclaimed / 1e6:.1f} MB in {chat_dir}")
+        exit(0)
     if args.export_chats_to_markdown:
-        for chat_file in chat_dir.iterdir():
-            if chat_file.is_file() and not chat_file.name.startswith('.'):
-                with chat_file.open() as f:
-                    try:
-                        chat = json.load(f)
-                        save_chat_as_markdown(chat, chat_file.stem)
-                    except Exception as e:
-                        print(f"Error while exporting chat {chat_file}: {e}")
+        export_chats_to_markdown(config.get('export_workers'))
         exit(0)
+    if args.batch:
+        output_file = args.batch_output
+        if output_file is None:
+            output_file = '-' if args.batch == '-' else str(Path(args.batch).with_suffix('.results.jsonl'))
+        exit(1 if run_batch(args.batch, output_file, args.batch_workers, args.batch_order) else 0)
+
+    from prompt_toolkit.history import FileHistory
+    from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
+    save_name_session = pt.PromptSession(history=FileHistory(prompt_history_dir /'saveing.txt'), auto_suggest=AutoSuggestFromHistory())
+    user_prompt_session = pt.PromptSession(history=FileHistory(project_dir /'user_prompt.txt'), auto_suggest=AutoSuggestFromHistory())
 
     if args.user_input:
         chat = GET_DEFAULT_CHAT()
-        chat.append({'role': 'user', 'content': args.user_input, 'user': config['user']})
+        chat.append(Message(role='user', content=args.user_input, user=config['user']))
     elif args.load_chat:
-        with (chat_dir / ensure_extension(args.load_chat, ".json")).open() as f:
-            chat = json.load(f)
+        chat = load_chat(chat_dir / ensure_extension(args.load_chat, ".json"))
     elif args.load_last_chat:
-        chat_path = [x for x in sorted(chat_dir.iterdir()) if x.is_file() and x.name.startswith('.backup')][-1]
-        with chat_path.open() as f:
-            chat = json.load(f)
+        chat_path = chat_catalog.last_backup()
+        if chat_path is None:
+            print(f"No backup chat found in {chat_dir}.")
+            exit(0)
+        chat = load_chat(chat_path)
+    elif args.search:
+        chat_path = search_chats(args.search)
+        if chat_path is None:
+            exit(0)
+        chat = load_chat(chat_path)
     else:
         chat = GET_DEFAULT_CHAT()
 
@@ -583,6 +3140,7 @@ def main():
 
     active_role = next_role(chat)
     prompt_postfix = config['prompt_postfix']
+    speaker = Speaker()
 
     while True:
         try:
@@ -592,11 +3150,12 @@ def main():
                 try:
                     prompt = f'{user_name}:{prompt_postfix}'
                     prompt = color_by_role(active_role, prompt)
-                    user_input = user_prompt_session.prompt(
-                        HTML(prompt), 
-                        bottom_toolbar=bottom_toolbar, 
-                        auto_suggest=AutoSuggestFromHistory(),
-                        multiline=True)
+                    with profiler.span('prompt input'):
+                        user_input = user_prompt_session.prompt(
+                            pt.HTML(prompt), 
+                            bottom_toolbar=bottom_toolbar, 
+                            auto_suggest=AutoSuggestFromHistory(),
+                            multiline=True)
                 except EOFError as e:
                     ctrl_d += 1
                 if ctrl_d > 0 or user_input in commands.exit.str_matches:
@@ -604,7 +3163,7 @@ def main():
                     while not chat_name or chat_name == '':
                         abort = False
                         try:
-                            chat_name = save_name_session.prompt('Save name: ', default=sanetize_filename(bottom_toolbar_session.summary), bottom_toolbar=bottom_toolbar, auto_suggest=AutoSuggestFromHistory())
+                            chat_name = save_name_session.prompt('Save name: ', default=sanetize_filename(bottom_toolbar_session.summarizer.current(timeout=config.get('summary_timeout', 5))), bottom_toolbar=bottom_toolbar, auto_suggest=AutoSuggestFromHistory())
                         except EOFError as e:
                             ctrl_d += 1
                         except KeyboardInterrupt as e:
@@ -626,6 +3185,7 @@ def main():
                     continue
                 elif user_input in commands.restart.str_matches:
                     backup_chat(chat)
+                    chat_tree.reset()
                     chat = GET_DEFAULT_CHAT()
                     pt.print_formatted_text('\n\n')
                     pt.print_formatted_text(chat)
@@ -634,6 +3194,7 @@ def main():
                 elif user_input in commands.restart_hard.str_matches:
                     backup_chat(chat)
                     print('\n\n')
+                    chat_tree.reset()
                     chat = []
                     active_role = next_role(chat)
                     continue
@@ -644,36 +3205,76 @@ def main():
                     list_chats(hide_backups=False)
                     continue
                 elif user_input in commands.load.str_matches:
-                    for chars in chat_dir.iterdir():
-                        if not chars.name.startswith('.'):
-                            print(f"{chars.name}")
+                    for name, *_ in chat_catalog.chats():
+                        print(name)
                     chat_name = pt.prompt('Name of chat to load: ')
                     if chat_name == 'exit':
                         continue
-                    with chat_dir.joinpath(ensure_extension(chat_name, ".json")).open() as f:
-                        backup_chat(chat)
-                        chat = json.load(f)
+                    backup_chat(chat)
+                    chat = load_chat(chat_dir / ensure_extension(chat_name, ".json"))
                     print('\n\n')
                     print_chat(chat)
                     continue 
+                elif user_input in commands.search.str_matches:
+                    chat_path = search_chats(pt.prompt('Search: '))
+                    if chat_path is None:
+                        continue
+                    backup_chat(chat)
+                    chat = load_chat(chat_path)
+                    print('\n\n')
+                    print_chat(chat)
+                    active_role = next_role(chat)
+                    continue
+                elif user_input in commands.more.str_matches:
+                    print_earlier_messages(chat)
+                    continue
                 elif user_input in commands.save.str_matches:
                     while not chat_name or (chat_dir / chat_name).exists() or chat_name == '':
                         chat_name = pt.prompt('Name chat: ').strip()
                         if chat_name == 'exit':
                             continue
                         time.sleep(0.1)
-                    with (chat_dir / ensure_extension(chat_name, ".json")).open("w") as f:
-                        json.dump(chat, f, indent=4)
+                    write_chat(chat, chat_dir / ensure_extension(chat_name, ".json"))
                     continue
                 elif user_input in commands.edit.str_matches:
                     chat = edit_chat(chat, user_input)
                     continue
                 elif len(chat) >= 3 and user_input in commands.regenerate.str_matches:
                     backup_chat(chat)
+                    alternative = chat_tree.keep_alternative(chat)
                     chat = chat[:-1]
-                    active_role = next_role(active_role)
+                    active_role = next_role(chat)
+                    print('\n\n')
+                    print_chat(chat)
+                    print(f"(The previous answer is kept on branch {alternative})")
+                    continue
+                elif user_input in commands.fork.str_matches:
+                    try:
+                        branch = chat_tree.fork(chat, pt.prompt('Name of the new branch (empty for a generated one): ').strip())
+                    except ValueError as e:
+                        print(e)
+                        continue
+                    print(f"Continuing on branch {branch}, forked from {chat_tree.parents[branch]}.")
+                    continue
+                elif user_input in commands.branches.str_matches:
+                    print_branches(chat)
+                    continue
+                elif user_input in commands.switch.str_matches or user_input in commands.pop.str_matches:
+                    try:
+                        if user_input in commands.pop.str_matches:
+                            chat = chat_tree.pop(chat)
+                        else:
+                            print_branches(chat)
+                            chat = chat_tree.switch(chat, pt.prompt('Name of branch to switch to: ').strip())
+                    except ValueError as e:
+                        print(e)
+                        continue
+                    # Save the branches right away, and not only when the journal is compacted
+                    backup_chat(chat)
+                    chat_journal.compact()
                     print('\n\n')
                     print_chat(chat)
+                    active_role = next_role(chat)
                     continue
                 elif user_input in commands.speak.str_matches:
                     args.speak = not args.speak
@@ -685,85 +3286,112 @@ def main():
                 elif user_input in commands.speak_last.str_matches:
                     Speaker().speak(speak_cmd, chat[-1]['content'])
                     continue
+                elif user_input in commands.speech_stats.str_matches:
+                    print(speech_cache.stats())
+                    continue
 
                 # Check if the user input starts with a model identifier, and if so,
                 # set the model appropriately
-                for n_model in models_dict.values():
-                    for name in [n_model['name']] + n_model['aliases']:
-                        if user_input.startswith(name):
-                            global model
-                            global max_tokens
-                            model = n_model['name']
-                            max_tokens = n_model['max_tokens']
-                            user_input = user_input[len(name):].strip()
-                        continue
+                with profiler.span('model switch'):
+                    for n_model in models_dict.values():
+                        for name in [n_model['name']] + n_model['aliases']:
+                            if user_input.startswith(name):
+                                global model
+                                global max_tokens
+                                model = n_model['name']
+                                max_tokens = n_model['max_tokens']
+                                user_input = user_input[len(name):].strip()
+                            continue
 
                 append_to_chat(chat, active_role, user_input)
-                backup_chat(chat)
                 active_role = next_role(chat)
             elif active_role == 'assistant':
                 # Get the content iterator
-                chat, num_tokens = trim_chat(chat)
-                max_retries = 5
-                for try_idx in itertools.count(1):
-                    try:
-                        exploded_chat = explode_chat(chat)
-                        response = openai.ChatCompletion.create(
-                            model=model,
-                            messages=[{k: v for k, v in y.items() if k in ['role', 'content']} for y in exploded_chat],
-                            stream = True,
-                        )
-                        break
-                    except TryAgain as e:
-                        if try_idx > max_retries:
-                            backup_chat(chat)
-                            raise e
-                        pt.print_formatted_text(HTML(HTML_color(f"Error. Retrying {try_idx}/{max_retries}", 'red')))
-                        if args.debug:
-                            pt.print_formatted_text(HTML(HTML_color(f"Error: {e}", 'red')))
-                        time.sleep(1)
+                context_chat = context_compressor.compressed_view(chat) if config.get('context_compression', True) else chat
+                with profiler.span('explode_chat', messages=len(context_chat)):
+                    exploded_chat = explode_chat(context_chat)
+                race = None
+                with profiler.span('trim_chat', messages=len(exploded_chat)):
+                    if race_models():
+                        # Every model gets the chat trimmed to its own context window
+                        race = CompletionRace([Racer(m, *trim_chat(exploded_chat, m, index=race_context_index(m))) for m in race_models()],
+                                              deadline=config.get('hedge_deadline', 10), keep_others=args.hedge_compare)
+                        num_tokens = race.racers[0].metrics.input_tokens
+                    else:
+                        exploded_chat, num_tokens = trim_chat(exploded_chat)
+                turn = telemetry.start_turn(model, speak=args.speak)
+                turn.input_tokens = num_tokens
+                def on_retry(attempt, max_retries, error, delay):
+                    pt.print_formatted_text(pt.HTML(HTML_color(f"\nError. Retrying {attempt}/{max_retries} in {delay:.1f}s", 'red')))
+                    if args.debug:
+                        pt.print_formatted_text(pt.HTML(HTML_color(f"Error: {html.escape(str(error))}", 'red')))
                 complete_response = []
-                pt.print_formatted_text(HTML(color_by_role(f'{model}:{prompt_postfix}')), end='', flush=True)
+                def print_prompt(l_model):
+                    pt.print_formatted_text(pt.HTML(color_by_role(f'{l_model}:{prompt_postfix}')), end='', flush=True)
+                if race:
+                    # The name of the model that answers is only known once the first token arrived
+                    completion = race.stream(on_response=lambda: turn.mark('response'), on_winner=lambda r: print_prompt(r.model))
+                else:
+                    print_prompt(model)
+                    completion = stream_completion(
+                        model=model,
+                        messages=api_messages(exploded_chat),
+                        on_response=lambda: turn.mark('response'),
+                        on_retry=on_retry)
 
                 # Process the content
-                speaker = Speaker()
-                read_buffer = ''
-                try:
-                    for chunk in response:
-                        c = None
-                        try:
-                            c = chunk.choices[0].delta.content
+                speaker = Speaker(on_first_audio=lambda: telemetry.first_audio(turn))
+                segmenter = SentenceSegmenter(config.get('tts_min_batch_chars', 80))
+                failed = False
+                with profiler.span('stream'):
+                    try:
+                        for c in completion:
                             complete_response.append(c)
-                            read_buffer += c
-                        except AttributeError as e:
-                            pass
-                        except Exception as e:
-                            print("\nAn error occured.")
-                            backup_chat(chat, prompt_name=True)
-                            raise e
-
-                        if c is None:
-                            continue
-
-                        print(c, end='', flush=True)
-
-                        # if speak_subproc is None or speak_subproc.poll() is not None:
-                        first_sentence, read_buffer = get_first_sentence(read_buffer)
-                        if first_sentence != '':
-                            speaker.speak(speak_cmd, first_sentence)
-                except KeyboardInterrupt as e:
-                    speaker.stop()
+                            turn.mark('first_token')
+                            print(c, end='', flush=True)
+
+                            for sentences in segmenter.feed(c):
+                                if args.speak:
+                                    speaker.speak(speak_cmd, sentences)
+                    except KeyboardInterrupt as e:
+                        speaker.stop()
+                        if race:
+                            race.cancel()
+                    except (openai.error.OpenAIError, requests.exceptions.RequestException) as e:
+                        # Keep what arrived so far, instead of losing it with the session
+                        pt.print_formatted_text(pt.HTML(HTML_color(f"\nError: {html.escape(str(e))}", 'red')))
+                        failed = True
+                turn.mark('end')
+                if race:
+                    race.record(turn)
 
                 # Speak the remaning buffer
-                speaker.speak(speak_cmd, read_buffer)
+                if args.speak:
+                    speaker.speak(speak_cmd, segmenter.flush())
                 complete_response = ''.join(complete_response)
-                append_to_chat(chat, 'assistant', complete_response)
+                if failed and complete_response == '':
+                    print("Enter 'pass' to try again.")
+                    active_role = 'user'
+                    continue
+                append_to_chat(chat, 'assistant', complete_response, l_model=turn.model)
+                turn.output_tokens = count_tokens(chat[-1], turn.model)
+                telemetry.end_turn(turn)
+                if race and args.hedge_compare:
+                    print('\n')
+                    race.print_answers()
+                    for r in race.racers:
+                        if r is not race.winner and r.content:
+                            alternative = chat_tree.keep_alternative(chat[:-1] + [Message(role='assistant', model=r.model, user=user, date=timestamp(), content=''.join(r.content))])
+                            print(f"(The answer of {r.model} is kept on branch {alternative})")
                 active_role = next_role(chat)
                 print()
         except KeyboardInterrupt:
             speaker.stop()
 
-        bottom_toolbar_session.background_update(chat)
+        with profiler.span('toolbar update'):
+            bottom_toolbar_session.background_update(chat)
+        if config.get('context_compression', True):
+            context_compressor.prepare(chat)
     
 def debug_notify(msg):
     if args.debug:
@@ -42,5 +42,601 @@ test_chat_1 = [
 def test_backup_chat():
     chat_path = gpt_ui.chat_dir / "test_chat_1.json"
     gpt_ui.backup_chat(test_chat_1, chat_path)
-    with chat_path.open() as f:
-        assert json.load(f) == test_chat_1
\ No newline at end of file
+    assert gpt_ui.read_chat_file(chat_path) == test_chat_1
+
+def test_message(monkeypatch):
+    chat = gpt_ui.chat_from_json(json.loads(json.dumps(test_chat_1 + [dict(test_chat_1[0], extra_key=1)])))
+    assert chat == test_chat_1 + [dict(test_chat_1[0], extra_key=1)]
+    assert json.loads(json.dumps(chat, default=gpt_ui.to_json)) == test_chat_1 + [dict(test_chat_1[0], extra_key=1)]
+    assert list(chat[-1].keys()) == ['role', 'model', 'user', 'date', 'content', 'extra_key']
+    assert chat[1]['user'] is chat[2]['user'] and chat[1]['model'] is chat[2]['model']
+    assert not hasattr(chat[0], '__dict__')
+    # The API message is only made again when the message changes
+    api_message = chat[1].api_message()
+    assert gpt_ui.api_messages(chat)[1] is api_message == {'role': 'user', 'content': 'hello'}
+    exploded = gpt_ui.with_content(chat[1], 'hello world')
+    assert exploded.api_message() == {'role': 'user', 'content': 'hello world'} and chat[1].api_message() is api_message
+    del chat[1]['model']
+    assert 'model' not in chat[1] and chat[1].get('model') is None
+    # Counting the tokens of an exploded copy leaves the counts of the original alone
+    monkeypatch.setitem(gpt_ui.tokenizers, 'words', WordTokenizer())
+    assert gpt_ui.count_tokens(chat[2], 'words') == 3
+    exploded = gpt_ui.with_content(chat[2], 'Hello! How can I help')
+    assert gpt_ui.count_tokens(exploded, 'words') == 5
+    assert chat[2]['token_counts'] == {'words': [gpt_ui.content_hash('Hello! How can'), 3]}
+
+class WordTokenizer:
+    name = 'words'
+    def encode(self, text, disallowed_special=()):
+        return text.split()
+
+def test_trim_chat(monkeypatch):
+    monkeypatch.setitem(gpt_ui.models_dict, 'test-model', {'name': 'test-model', 'max_tokens': 60, 'encoding': 'words', 'reserved_completion_tokens': 10})
+    monkeypatch.setitem(gpt_ui.tokenizers, 'words', WordTokenizer())
+    chat = [{'role': 'system', 'content': 'one two three'}] + [{'role': 'user', 'content': 'a b c d e f g'} for _ in range(10)]
+    trimmed, num_tokens = gpt_ui.trim_chat(chat, 'test-model')
+    # 60 - 10 completion - 3 reply - 6 system leaves room for 4 messages of 10 tokens each
+    assert trimmed == [chat[0]] + chat[-4:]
+    assert num_tokens == 6 + 4 * 10 + 3
+    assert chat[1]['token_counts'] == {'words': [gpt_ui.content_hash('a b c d e f g'), 7]}
+
+def test_chat_catalog(tmp_path):
+    catalog = gpt_ui.ChatCatalog(tmp_path / '.catalog.sqlite', tmp_path)
+    for name in ['b.json', '.backup_1.json', '.backup_2.json']:
+        with (tmp_path / name).open('w') as f:
+            json.dump(test_chat_1, f)
+    assert [r[0] for r in catalog.chats()] == ['b.json']
+    assert catalog.last_backup() == tmp_path / '.backup_2.json'
+    (tmp_path / '.backup_2.json').unlink()
+    catalog.update(tmp_path / 'b.json', test_chat_1[:2], summary='greeting')
+    assert catalog.chats(hide_backups=False) == [
+        ('.backup_1.json', 5, test_chat_1[-1]['content'], 'gpt-4', ''),
+        ('b.json', 2, 'hello', 'gpt-4', 'greeting')]
+
+def test_chat_search(tmp_path):
+    catalog = gpt_ui.ChatCatalog(tmp_path / '.catalog.sqlite', tmp_path)
+    chat = [dict(m) for m in test_chat_1]
+    for name in ['named.json', '.backup_1.json']:
+        with (tmp_path / name).open('w') as f:
+            json.dump(chat, f)
+    results = catalog.search('questions, feel')
+    # The message is in both chats, but only shown for the named one
+    assert [r[:3] for r in results] == [('named.json', 'assistant', chat[4]['date'])]
+    assert gpt_ui.sqlite3.connect(tmp_path / '.catalog.sqlite').execute('SELECT count(*) FROM messages').fetchone()[0] == len(chat)
+    assert '**questions**' in results[0][3]
+    chat[4]['content'] = 'Something else entirely.'
+    chat.append({'role': 'user', 'date': '2023-05-14', 'content': 'Which questions?'})
+    gpt_ui.write_chat(chat, tmp_path / 'named.json')
+    catalog.update(tmp_path / 'named.json', chat)
+    # Words are stemmed, so the system prompt matches too
+    assert [r[:2] for r in catalog.search('question')] == [('named.json', 'user'), ('named.json', 'system'), ('.backup_1.json', 'assistant')]
+    (tmp_path / '.backup_1.json').unlink()
+    assert catalog.search('entirely') == [('named.json', 'assistant', chat[4]['date'], 'Something else **entirely**.')]
+    assert catalog.search('feel') == []
+
+def test_chat_journal(tmp_path, monkeypatch):
+    monkeypatch.setattr(gpt_ui, 'chat_catalog', gpt_ui.ChatCatalog(tmp_path / '.catalog.sqlite', tmp_path))
+    journal = gpt_ui.ChatJournal(tmp_path / 'chat.json', fsync_interval=0)
+    chat = [dict(m) for m in test_chat_1[:3]]
+    journal.write(chat)
+    assert not gpt_ui.journal_path(tmp_path / 'chat.json').exists()
+    chat.append(dict(test_chat_1[3]))
+    journal.write(chat)
+    chat[1] = dict(chat[1], content='hello again')
+    journal.write(chat)
+    with gpt_ui.journal_path(tmp_path / 'chat.json').open() as f:
+        # One append, then a truncate and the rewritten tail
+        assert len(f.readlines()) == 5
+    assert gpt_ui.load_chat(tmp_path / 'chat.json') == chat
+    journal.compact()
+    assert not gpt_ui.journal_path(tmp_path / 'chat.json').exists()
+    assert gpt_ui.load_chat(tmp_path / 'chat.json') == chat
+    # The catalog is updated when the journal is synced, and not on every write
+    journal = gpt_ui.ChatJournal(tmp_path / 'chat.json', fsync_interval=3600)
+    journal.write(chat)
+    journal.write(chat + [dict(test_chat_1[0])])
+    assert gpt_ui.chat_catalog.chats(hide_backups=False)[0][1] == 4
+    journal.fsync()
+    assert gpt_ui.chat_catalog.chats(hide_backups=False)[0][1] == 5
+    # The journal of a crashed session is compacted when its backup is loaded, but not one that is still written
+    monkeypatch.setattr(gpt_ui, 'chat_tree', gpt_ui.ChatTree())
+    crashed = tmp_path / '.backup_crashed.json'
+    journal = gpt_ui.ChatJournal(crashed, fsync_interval=0)
+    journal.write(chat[:2])
+    journal.write(chat)
+    assert gpt_ui.load_chat(crashed) == chat
+    assert gpt_ui.journal_path(crashed).exists()
+    journal.file.close()
+    assert gpt_ui.load_chat(crashed) == chat
+    assert not gpt_ui.journal_path(crashed).exists()
+    assert gpt_ui.read_chat_file(crashed) == chat
+    # And when the chats are collected
+    journal = gpt_ui.ChatJournal(crashed, fsync_interval=0)
+    journal.write(chat + [dict(test_chat_1[0])])
+    journal.file.close()
+    monkeypatch.setattr(gpt_ui, 'chat_dir', tmp_path)
+    gpt_ui.gc_chats(keep_last=10, keep_daily=10)
+    assert not gpt_ui.journal_path(crashed).exists()
+    assert gpt_ui.read_chat_file(crashed) == chat + [test_chat_1[0]]
+
+def test_chat_journal_ignores_token_counts(tmp_path, monkeypatch):
+    monkeypatch.setitem(gpt_ui.tokenizers, 'words', WordTokenizer())
+    journal = gpt_ui.ChatJournal(tmp_path / 'chat.json', fsync_interval=0)
+    chat = gpt_ui.chat_from_json(test_chat_1[:3])
+    journal.write(chat)
+    gpt_ui.number_of_tokens(chat, 'words')
+    chat.append(gpt_ui.Message(test_chat_1[3]))
+    journal.write(chat)
+    gpt_ui.number_of_tokens(chat, 'words')
+    journal.write(chat)
+    with gpt_ui.journal_path(tmp_path / 'chat.json').open() as f:
+        # Only the appended message, counting tokens is no change
+        assert len(f.readlines()) == 1
+
+def test_lazy_chat(tmp_path, monkeypatch):
+    monkeypatch.setitem(gpt_ui.config, 'lazy_chat_prefetch', False)
+    monkeypatch.setitem(gpt_ui.config, 'chat_storage', 'json')
+    path = tmp_path / 'long.json'
+    chat = [dict(test_chat_1[i % 4], content=f'message {i} \u00e4') for i in range(gpt_ui.LazyChat.page_size * 3 + 10)]
+    gpt_ui.write_chat(chat, path)
+    with path.open() as f:
+        assert json.load(f) == chat
+    lazy = gpt_ui.load_chat(path)
+    assert isinstance(lazy, gpt_ui.LazyChat)
+    assert lazy.n_unread() == len(chat) - 10
+    assert lazy[-1]['content'] == chat[-1]['content']
+    # Pages that were not read yet still come from the chat as it was loaded, even if the file is overwritten
+    gpt_ui.write_chat(chat[:2], path)
+    lazy.append(gpt_ui.Message(role='user', content='new'))
+    assert lazy == chat + [{'role': 'user', 'content': 'new'}]
+    assert lazy.n_unread() == 0
+    # Small chats are loaded as they are
+    assert type(gpt_ui.load_chat(path)) is list
+
+def test_message_store(tmp_path, monkeypatch):
+    monkeypatch.setitem(gpt_ui.config, 'lazy_chat_prefetch', False)
+    monkeypatch.setattr(gpt_ui, 'chat_dir', tmp_path)
+    monkeypatch.setattr(gpt_ui, 'chat_catalog', gpt_ui.ChatCatalog(tmp_path / '.catalog.sqlite', tmp_path))
+    long_chat = [dict(test_chat_1[i % 4], content=f'message {i}') for i in range(gpt_ui.LazyChat.page_size + 10)]
+    gpt_ui.write_chat(long_chat, tmp_path / 'long.json')
+    for day in ['2023-05-11', '2023-05-12', '2023-05-13']:
+        for time in ['08-00-00-000000', '20-00-00-000000']:
+            gpt_ui.write_chat(test_chat_1 + [dict(test_chat_1[1], content=f'{day} {time}')], tmp_path / f'.backup_{day}_{time}.json')
+    # Counting tokens does not store a message again
+    n_stored = gpt_ui.sqlite3.connect(tmp_path / '.messages.sqlite').execute('SELECT count(*) FROM messages').fetchone()[0]
+    counted = gpt_ui.chat_from_json(test_chat_1[2:4])
+    monkeypatch.setitem(gpt_ui.tokenizers, 'words', WordTokenizer())
+    gpt_ui.number_of_tokens(counted, 'words')
+    gpt_ui.write_chat(counted, tmp_path / 'counted.json')
+    assert gpt_ui.sqlite3.connect(tmp_path / '.messages.sqlite').execute('SELECT count(*) FROM messages').fetchone()[0] == n_stored
+    # But the counts are stored, such that they are not counted again after loading
+    assert [m['token_counts'] for m in gpt_ui.read_chat_file(tmp_path / 'counted.json')] == [m['token_counts'] for m in counted]
+    (tmp_path / 'counted.json').unlink()
+    # Backups share all but their last message
+    assert gpt_ui.MessageStore(tmp_path / '.messages.sqlite').read(json.loads((tmp_path / 'long.json').read_text())['messages']) == long_chat
+    lazy = gpt_ui.load_chat(tmp_path / 'long.json')
+    assert lazy.n_unread() == len(long_chat) - 10
+    # Messages that were not read are written by their hash
+    gpt_ui.write_chat_file(lazy, tmp_path / 'copy.json')
+    assert lazy.n_unread() == len(long_chat) - 10
+    (tmp_path / 'plain.json').write_text(json.dumps(test_chat_1[:2]))
+    (tmp_path / '.backup_2023-05-10_08-00-00-000000.json').write_text(json.dumps([dict(test_chat_1[0], content='only here')]))
+
+    n_backups, n_moved, n_messages, reclaimed = gpt_ui.gc_chats(keep_last=1, keep_daily=2)
+    assert sorted(p.name for p in tmp_path.glob('.backup_*.json')) == \
+        ['.backup_2023-05-12_20-00-00-000000.json', '.backup_2023-05-13_20-00-00-000000.json']
+    assert (n_backups, n_moved, n_messages) == (5, 1, 4)
+    assert reclaimed > 0
+    assert gpt_ui.read_chat_file(tmp_path / 'plain.json') == test_chat_1[:2]
+    assert gpt_ui.load_chat(tmp_path / 'copy.json') == long_chat
+    assert [name for name, *_ in gpt_ui.chat_catalog.chats(hide_backups=False)][:2] == \
+        ['.backup_2023-05-12_20-00-00-000000.json', '.backup_2023-05-13_20-00-00-000000.json']
+
+def test_chat_tree(tmp_path, monkeypatch):
+    monkeypatch.setattr(gpt_ui, 'chat_tree', gpt_ui.ChatTree())
+    monkeypatch.setattr(gpt_ui, 'chat_catalog', gpt_ui.ChatCatalog(tmp_path / '.catalog.sqlite', tmp_path))
+    tree = gpt_ui.chat_tree
+    chat = gpt_ui.chat_from_json(test_chat_1[:3])
+    assert tree.fork(chat, 'subtopic') == 'subtopic'
+    chat.append(gpt_ui.Message(test_chat_1[3]))
+    chat = tree.switch(chat, 'main')
+    assert len(chat) == 3 and tree.chats['subtopic'][0] is chat[0]
+    assert tree.keep_alternative(chat) == 'main~1'
+    chat = chat[:-1] + [gpt_ui.Message(test_chat_1[4])]
+    for storage in ['store', 'json']:
+        monkeypatch.setitem(gpt_ui.config, 'chat_storage', storage)
+        gpt_ui.write_chat(chat, tmp_path / f'{storage}.json')
+        loaded = gpt_ui.load_chat(tmp_path / f'{storage}.json')
+        assert loaded == chat
+        assert tree.parents == {'main': None, 'subtopic': 'main', 'main~1': 'main'}
+        # Only the messages after the ones shared with main are saved, and they are shared again after loading
+        assert [len(b['messages']) for b in gpt_ui.read_chat_branches(tmp_path / f'{storage}.json')['branches'].values()] == [2, 1]
+        assert tree.chats['subtopic'][1] is loaded[1] and tree.chats['subtopic'][3] == test_chat_1[3]
+        assert tree.chats['main~1'] == test_chat_1[:3]
+    chat = tree.switch(loaded, 'subtopic')
+    assert chat == test_chat_1[:4]
+    assert tree.pop(chat) == loaded
+    assert tree.active == 'main' and 'subtopic' not in tree.parents
+
+def test_sentence_segmenter():
+    text = 'Hi there. This is e.g. a list:\n1. First.\n```python\nx = 1. \n```\nDone! Bye'
+    segmenter = gpt_ui.SentenceSegmenter(min_batch_chars=0)
+    sentences = []
+    for c in text:
+        sentences += segmenter.feed(c)
+    sentences.append(segmenter.flush())
+    assert sentences == ['Hi there.', ' This is e.g. a list:\n', '1. First.\n', 'x = 1. \n', 'Done!', ' Bye']
+    # The chunks of a long sentence are only joined once it may end
+    for _ in range(1000):
+        assert segmenter.feed('word ') == []
+    assert len(segmenter.parts) == 1000
+    assert segmenter.feed('end. ') == ['word ' * 1000 + 'end.']
+
+def test_explode_chat(tmp_path):
+    note = tmp_path / 'note.txt'
+    note.write_text('first version')
+    chat = [dict(test_chat_1[0]), {'role': 'user', 'content': f'Look at :file:{note}:'}]
+    exploded = gpt_ui.explode_chat(chat)
+    assert exploded[0] is chat[0]
+    assert 'first version' in exploded[1]['content']
+    assert gpt_ui.explode_chat(chat)[1] is exploded[1]
+    note.write_text('second version!')
+    assert 'second version!' in gpt_ui.explode_chat(chat)[1]['content']
+    assert chat[1]['content'] == f'Look at :file:{note}:'
+
+def test_vault_index(tmp_path):
+    vault = tmp_path / 'vault'
+    (vault / 'projects' / '.trash').mkdir(parents=True)
+    (vault / 'projects' / 'Plan.md').write_text('plan')
+    (vault / 'projects' / '.trash' / 'Old.md').write_text('old')
+    index = gpt_ui.VaultIndex(vault, tmp_path / 'index.json')
+    assert index.find('Plan.md') == [vault / 'projects' / 'Plan.md']
+    assert index.find('projects/Plan.md') == [vault / 'projects' / 'Plan.md']
+    assert index.find('Old.md') == []
+    (vault / 'Plan.md').write_text('another plan')
+    index.refresh()
+    assert sorted(index.find('Plan.md')) == [vault / 'Plan.md', vault / 'projects' / 'Plan.md']
+    # A fresh index starts from the persisted one
+    assert sorted(gpt_ui.VaultIndex(vault, tmp_path / 'index.json').find('Plan.md')) == sorted(index.find('Plan.md'))
+
+def test_summarizer(monkeypatch):
+    calls = []
+    def get_summary(chat, previous_summary=''):
+        calls.append((len(chat), previous_summary))
+        return f'summary {len(calls)}'
+    monkeypatch.setattr(gpt_ui, 'get_summary', get_summary)
+    summarizer = gpt_ui.Summarizer(debounce=0)
+    chat = [dict(m) for m in test_chat_1]
+    summarizer.request(chat[:3])
+    assert summarizer.current() == 'summary 1'
+    summarizer.request(chat)
+    assert summarizer.current() == 'summary 2'
+    # Going back to a summarized prefix is served from the cache
+    summarizer.request(chat[:3])
+    assert summarizer.current() == 'summary 1'
+    assert calls == [(3, ''), (2, 'summary 1')]
+    # A failed summary does not keep later requests from being summarized
+    def broken_summary(chat, previous_summary=''):
+        raise ConnectionError('offline')
+    monkeypatch.setattr(gpt_ui, 'get_summary', broken_summary)
+    summarizer.request(chat[:4])
+    assert summarizer.current() == 'summary 1'
+    monkeypatch.setattr(gpt_ui, 'get_summary', get_summary)
+    summarizer.request(chat[:4])
+    assert summarizer.current() == 'summary 3'
+
+def test_context_compressor(monkeypatch):
+    monkeypatch.setitem(gpt_ui.models_dict, 'test-model', {'name': 'test-model', 'max_tokens': 100, 'encoding': 'words', 'reserved_completion_tokens': 0})
+    monkeypatch.setitem(gpt_ui.tokenizers, 'words', WordTokenizer())
+    monkeypatch.setitem(gpt_ui.config, 'compression_model', 'test-model')
+    calls = []
+    def compress_messages(chat, previous_summary, l_model):
+        calls.append((len(chat), previous_summary))
+        return f'compressed {len(calls)}'
+    monkeypatch.setattr(gpt_ui, 'compress_messages', compress_messages)
+    compressor = gpt_ui.ContextCompressor(threshold=0.8, keep=0.5)
+    chat = [{'role': 'system', 'content': 'be brief'}] + [{'role': 'user', 'content': 'a b c d e f g'} for _ in range(9)]
+    compressor.prepare(chat, 'test-model')
+    compressor.worker.join()
+    assert compressor.compressed_view(chat) is chat
+    chat += [{'role': 'user', 'content': 'a b c d e f g'} for _ in range(3)]
+    compressor.prepare(chat, 'test-model')
+    compressor.worker.join()
+    view = compressor.compressed_view(chat)
+    # With 10 tokens per message, the last 5 messages fill half of the context window. The 7 messages before them are
+    # compressed in chunks of at most half the context window of the compression model.
+    assert view == [chat[0], {'role': 'system', 'content': 'Summary of the earlier conversation: compressed 2'}] + chat[-5:]
+    assert calls == [(5, ''), (2, 'compressed 1')]
+
+class ListBackend:
+    def __init__(self, chunks):
+        self.chunks = chunks
+    def create(self, **request):
+        return iter(self.chunks)
+
+def test_record_and_replay(tmp_path):
+    chunks = [{'choices': [{'index': 0, 'delta': {'content': c}}]} for c in ['Hello', ' there.']]
+    recorder = gpt_ui.RecordingBackend(ListBackend(chunks), tmp_path / 'recordings.jsonl')
+    messages = [{'role': 'user', 'content': 'hi'}]
+    assert list(recorder.create(model='gpt-4', messages=messages, stream=True)) == chunks
+    replayer = gpt_ui.ReplayBackend(tmp_path / 'recordings.jsonl', delay=0)
+    assert [c.choices[0].delta.content for c in replayer.create(model='gpt-4', messages=messages, stream=True)] == ['Hello', ' there.']
+    response = replayer.create(model='gpt-4', messages=[{'role': 'user', 'content': 'something else'}])
+    assert response['choices'][0].message['content'] == 'Hello there.'
+
+def test_telemetry(tmp_path, monkeypatch):
+    monkeypatch.setitem(gpt_ui.models_dict, 'test-model', {'name': 'test-model', 'cost_per_input_token': 0.5, 'cost_per_output_token': 1})
+    telemetry = gpt_ui.Telemetry(tmp_path / 'metrics.jsonl', prometheus_path=tmp_path / 'gpt_ui.prom')
+    turn = telemetry.start_turn('test-model', speak=True)
+    turn.input_tokens, turn.output_tokens = 10, 4
+    for event in ['response', 'first_token', 'first_token', 'end']:
+        turn.mark(event)
+    telemetry.end_turn(turn)
+    # Spoken turns are written once the audio started
+    assert not (tmp_path / 'metrics.jsonl').exists()
+    assert telemetry.session_cost == 9
+    telemetry.first_audio(turn)
+    record = json.loads((tmp_path / 'metrics.jsonl').read_text())
+    assert record['cost'] == 9 and record['output_tokens'] == 4
+    assert record['first_audio_seconds'] >= record['time_to_first_token_seconds'] >= record['request_setup_seconds'] >= 0
+    assert 'gpt_ui_cost_dollars_total{model="test-model"} 9.0' in (tmp_path / 'gpt_ui.prom').read_text()
+    # Batch workers end their turns concurrently
+    def end_turns():
+        for _ in range(50):
+            telemetry.end_turn(telemetry.start_turn('test-model'))
+    workers = [gpt_ui.Thread(target=end_turns) for _ in range(8)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert 'gpt_ui_turns_total{model="test-model"} 401' in (tmp_path / 'gpt_ui.prom').read_text()
+    # Metrics that cannot be written do not fail the turn
+    broken = gpt_ui.Telemetry(tmp_path / 'missing' / 'metrics.jsonl', prometheus_path=tmp_path / 'missing' / 'gpt_ui.prom')
+    broken.end_turn(broken.start_turn('test-model'))
+
+def test_read_file_content(tmp_path, monkeypatch):
+    monkeypatch.setattr(gpt_ui, 'max_embedded_file_bytes', 8)
+    small = tmp_path / 'small.txt'
+    small.write_bytes(b'one\r\ntwo\r\nthree\r\n')
+    assert gpt_ui.read_file_content(small) == 'one\ntwo\n[Truncated: only the first 8 of 17 bytes of this file are shown]'
+    monkeypatch.setattr(gpt_ui, 'mmap_threshold_bytes', 0)
+    assert gpt_ui.read_file_content(small) == 'one\ntwo\n[Truncated: only the first 8 of 17 bytes of this file are shown]'
+
+def test_speech_cache(tmp_path):
+    cache = gpt_ui.SpeechCache(tmp_path, max_bytes=10, max_age_days=1)
+    now = gpt_ui.time.time()
+    old = cache.path('tts', 'old', 1, '.mp3')
+    old.write_bytes(b'x')
+    gpt_ui.os.utime(old, (now - 2 * 24 * 60 * 60,) * 2)
+    a = cache.path('tts', 'a', 1, '.mp3')
+    assert not cache.lookup(a)
+    a.write_bytes(b'aaaa')
+    cache.add(a, 2.0)
+    assert cache.lookup(a)
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'synthesis_seconds': 2.0, 'saved_seconds': 2.0}
+    # Files older than max_age_days are evicted
+    assert not old.exists() and cache.total_bytes == 4
+    b = cache.path('tts', 'b', 1, '.mp3')
+    b.write_bytes(b'bbbb')
+    cache.add(b, 1.0)
+    assert cache.total_bytes == 8
+    # Beyond max_bytes, the least recently used files are evicted
+    gpt_ui.os.utime(a, (now - 10,) * 2)
+    gpt_ui.os.utime(b, (now - 5,) * 2)
+    assert cache.lookup(a)
+    c = cache.path('tts', 'c', 1, '.mp3')
+    c.write_bytes(b'cccc')
+    cache.add(c, 1.0)
+    assert a.exists() and not b.exists() and c.exists()
+    assert cache.total_bytes == 8
+
+def test_speaker(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    # tts --output-file FILE --speed SPEED -- TEXT
+    (bin_dir / 'tts').write_text('#!/bin/sh\ncase "$6" in slow*) sleep 0.3;; esac\nprintf "%s\\n" "$6" > "$2"\n')
+    # mpv --really-quiet --speed=SPEED FILE
+    (bin_dir / 'mpv').write_text('#!/bin/sh\ncat "$3" >> "$(dirname "$0")/played.txt"\ncase "$(cat "$3")" in block*) exec sleep 10;; esac\n')
+    for script in bin_dir.iterdir():
+        script.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}{gpt_ui.os.pathsep}{gpt_ui.os.environ['PATH']}")
+    (tmp_path / 'cache').mkdir()
+    monkeypatch.setattr(gpt_ui, 'speech_cache', gpt_ui.SpeechCache(tmp_path / 'cache', max_bytes=2 ** 20, max_age_days=1))
+    played = bin_dir / 'played.txt'
+    def wait_for(condition):
+        deadline = gpt_ui.time.time() + 5
+        while not condition() and gpt_ui.time.time() < deadline:
+            gpt_ui.time.sleep(0.01)
+        assert condition()
+    # Sentences are played in order, also when a later one is synthesized first
+    speaker = gpt_ui.Speaker(workers=3, prefetch=3)
+    for text in ['slow one.', 'two.', 'three.']:
+        speaker.speak('tts', text)
+    wait_for(lambda: speaker.playback_thread is None)
+    assert played.read_text().splitlines() == ['slow one.', 'two.', 'three.']
+    assert speaker.backlog_chars == 0
+    # Audio that cannot be played does not stop the speaker
+    (bin_dir / 'mpv').chmod(0o644)
+    speaker.speak('tts', 'four.')
+    wait_for(lambda: speaker.playback_thread is None)
+    (bin_dir / 'mpv').chmod(0o755)
+    speaker.speak('tts', 'five.')
+    wait_for(lambda: speaker.playback_thread is None)
+    assert played.read_text().splitlines()[3:] == ['five.']
+    # Stopping ends the playback and cancels what was not played yet
+    speaker = gpt_ui.Speaker(workers=1, prefetch=1)
+    for text in ['block.', 'six.', 'seven.']:
+        speaker.speak('tts', text)
+    thread = speaker.playback_thread
+    wait_for(lambda: 'block.' in played.read_text())
+    speaker.stop()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    speaker.speak('tts', 'eight.')
+    assert speaker.playback_thread is None
+    assert played.read_text().splitlines()[4:] == ['block.']
+
+def test_profiler(tmp_path):
+    profiler = gpt_ui.Profiler(tmp_path / 'profile.json', cprofile_phase='work')
+    traced = profiler.profiled('work')(lambda n: sum(range(n)))
+    with profiler.span('outer', messages=3):
+        assert traced(100) == 4950
+    worker = gpt_ui.Thread(target=traced, args=[10], name='worker')
+    worker.start()
+    worker.join()
+    profiler.save()
+    trace = json.loads((tmp_path / 'profile.json').read_text())['traceEvents']
+    spans = [e for e in trace if e['ph'] == 'X']
+    assert [e['name'] for e in spans] == ['work', 'outer', 'work']
+    assert spans[1]['args'] == {'messages': 3} and spans[1]['dur'] >= spans[0]['dur']
+    assert 'worker' in [e['args']['name'] for e in trace if e['ph'] == 'M']
+    assert (tmp_path / 'profile.prof').exists()
+
+class EchoBackend:
+    """Answers with the prompt in upper case, and fails once for prompts starting with 'flaky'."""
+    def __init__(self, error):
+        self.error = error
+        self.failed = set()
+    def create(self, **request):
+        prompt = request['messages'][-1]['content']
+        if prompt.startswith('flaky') and prompt not in self.failed:
+            self.failed.add(prompt)
+            raise self.error
+        return {'choices': [{'message': {'role': 'assistant', 'content': prompt.upper()}}],
+                'usage': {'prompt_tokens': 5, 'completion_tokens': 2}}
+
+def test_run_batch(tmp_path, monkeypatch):
+    monkeypatch.setitem(gpt_ui.models_dict, 'test-model', {'name': 'test-model', 'max_tokens': 100, 'encoding': 'words', 'aliases': ['tm'],
+                                                           'cost_per_input_token': 1, 'cost_per_output_token': 1, 'requests_per_minute': 6000})
+    monkeypatch.setitem(gpt_ui.tokenizers, 'words', WordTokenizer())
+    monkeypatch.setattr(gpt_ui, 'telemetry', gpt_ui.Telemetry(tmp_path / 'metrics.jsonl'))
+    monkeypatch.setattr(gpt_ui, 'backoff_delay', lambda attempt: 0)
+    monkeypatch.setattr(gpt_ui, 'completion_backend', EchoBackend(gpt_ui.openai.error.RateLimitError('slow down')))
+    personality = f'{gpt_ui.args.personality}.yaml'
+    (tmp_path / personality).write_text((gpt_ui.prompt_dir / personality).read_text())
+    monkeypatch.setattr(gpt_ui, 'prompt_dir', tmp_path)
+    prompts = tmp_path / 'prompts.jsonl'
+    prompts.write_text('\n'.join(json.dumps(p) for p in [
+        {'prompt': 'hello', 'model': 'tm'}, {'prompt': 'flaky one', 'model': 'test-model', 'id': 'f'},
+        {'prompt': 'bye', 'model': 'tm', 'personality': 'does_not_exist'}]))
+    output = tmp_path / 'results.jsonl'
+    assert gpt_ui.run_batch(str(prompts), str(output), workers=3) == 1
+    results = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [r['id'] for r in results] == [0, 'f', 2]
+    assert results[0]['response'] == 'HELLO' and results[0]['cost'] == 7
+    assert results[1]['attempts'] == 2
+    assert 'FileNotFoundError' in results[2]['error']
+    # Resuming only retries the failed prompt
+    (tmp_path / 'does_not_exist.yaml').write_text('- role: system\n  content: test\n')
+    assert gpt_ui.run_batch(str(prompts), str(output), workers=3) == 0
+    assert [json.loads(line)['id'] for line in output.read_text().splitlines()] == [0, 'f', 2, 2]
+
+def test_rate_limiter(monkeypatch):
+    clock = [0.0]
+    sleeps = []
+    def sleep(seconds):
+        sleeps.append(seconds)
+        clock[0] += seconds
+    monkeypatch.setattr(gpt_ui.time, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(gpt_ui.time, 'sleep', sleep)
+    limiter = gpt_ui.RateLimiter(requests_per_minute=60, tokens_per_minute=600)
+    limiter.acquire(500)
+    limiter.charge(200)
+    assert sleeps == []
+    # The bucket is 100 tokens in debt, so 100 more tokens take 20 seconds
+    limiter.acquire(100)
+    assert sleeps == [20]
+
+def test_export_chats_to_markdown(tmp_path, monkeypatch):
+    monkeypatch.setattr(gpt_ui, 'chat_dir', tmp_path)
+    for name in ['a', 'b', '.backup_1']:
+        (tmp_path / f'{name}.json').write_text(json.dumps(test_chat_1))
+    (tmp_path / 'broken.json').write_text('{')
+    assert gpt_ui.export_chats_to_markdown() == 2
+    assert (tmp_path / 'a.md').read_text() == gpt_ui.chat_to_markdown(test_chat_1)
+    assert not (tmp_path / '.backup_1.md').exists()
+    # Nothing is newer than its markdown, and a newer chat with the same content is not written again
+    assert gpt_ui.export_chats_to_markdown() == 0
+    gpt_ui.os.utime(tmp_path / 'a.json', ns=(0, (tmp_path / 'a.md').stat().st_mtime_ns + 1))
+    assert gpt_ui.export_chats_to_markdown() == 0
+    # The markdown is touched, such that the chat is not read again on the next export
+    assert (tmp_path / 'a.md').stat().st_mtime_ns >= (tmp_path / 'a.json').stat().st_mtime_ns
+    read_chat_file = gpt_ui.read_chat_file
+    read = []
+    monkeypatch.setattr(gpt_ui, 'read_chat_file', lambda path: read.append(path.name) or read_chat_file(path))
+    assert gpt_ui.export_chats_to_markdown() == 0
+    assert read == ['broken.json']
+    monkeypatch.setattr(gpt_ui, 'read_chat_file', read_chat_file)
+    (tmp_path / 'b.json').write_text(json.dumps(test_chat_1[:2]))
+    gpt_ui.os.utime(tmp_path / 'b.json', ns=(0, (tmp_path / 'b.md').stat().st_mtime_ns + 1))
+    monkeypatch.setattr(gpt_ui, 'export_pool_threshold', 0)
+    assert gpt_ui.export_chats_to_markdown(workers=2) == 1
+    assert (tmp_path / 'b.md').read_text() == gpt_ui.chat_to_markdown(test_chat_1[:2])
+
+class BreakingBackend:
+    """Streams the chunks, but the first stream breaks after two of them."""
+    def __init__(self, chunks, error):
+        self.chunks = chunks
+        self.error = error
+        self.requests = []
+    def create(self, **request):
+        self.requests.append(request)
+        if len(self.requests) == 1:
+            return self._broken_stream()
+        return iter(self.chunks[2:])
+    def _broken_stream(self):
+        yield from self.chunks[:2]
+        raise self.error
+
+def test_stream_completion_resumes(monkeypatch):
+    chunks = [{'choices': [{'index': 0, 'delta': {'content': c}}]} for c in ['One, ', 'two, ', 'three.']]
+    backend = BreakingBackend(chunks, gpt_ui.requests.exceptions.ChunkedEncodingError('connection dropped'))
+    monkeypatch.setattr(gpt_ui, 'completion_backend', backend)
+    monkeypatch.setattr(gpt_ui, 'backoff_delay', lambda attempt: 0)
+    retries = []
+    messages = [{'role': 'user', 'content': 'Count to three.'}]
+    content = list(gpt_ui.stream_completion(model='gpt-4', messages=messages, on_retry=lambda *a: retries.append(a[0])))
+    assert content == ['One, ', 'two, ', 'three.']
+    assert retries == [1]
+    # The retry continues the partial answer
+    assert backend.requests[1]['messages'][:2] == messages + [{'role': 'assistant', 'content': 'One, two, '}]
+    assert gpt_ui.is_retryable(gpt_ui.openai.error.APIError('bad gateway', http_status=502))
+    assert not gpt_ui.is_retryable(gpt_ui.openai.error.InvalidRequestError('too long', param=None))
+
+class DelayedBackend:
+    """Streams a different answer for every model, starting after a delay per model."""
+    def __init__(self, answers, delays):
+        self.answers = answers
+        self.delays = delays
+    def create(self, model, **request):
+        def stream():
+            gpt_ui.time.sleep(self.delays[model])
+            for word in self.answers[model].split():
+                yield {'choices': [{'index': 0, 'delta': {'content': word + ' '}}]}
+        return stream()
+
+def test_completion_race(monkeypatch):
+    for name in ['fast-model', 'slow-model']:
+        monkeypatch.setitem(gpt_ui.models_dict, name, {'name': name, 'max_tokens': 100, 'encoding': 'words', 'cost_per_output_token': 1})
+    monkeypatch.setitem(gpt_ui.tokenizers, 'words', WordTokenizer())
+    monkeypatch.setattr(gpt_ui, 'completion_backend', DelayedBackend({'fast-model': 'fast answer', 'slow-model': 'slow but thorough answer'},
+                                                                     {'fast-model': 0, 'slow-model': 0.2}))
+    chat = [{'role': 'user', 'content': 'hi'}]
+    def race(**kwargs):
+        race = gpt_ui.CompletionRace([gpt_ui.Racer(m, chat, 1) for m in ['slow-model', 'fast-model']], **kwargs)
+        winners = []
+        answer = ''.join(race.stream(on_winner=winners.append))
+        turn = gpt_ui.TurnMetrics('slow-model')
+        race.record(turn)
+        return answer, winners, turn
+    answer, winners, turn = race()
+    assert answer == 'fast answer '
+    assert [r.model for r in winners] == ['fast-model'] and turn.model == 'fast-model'
+    assert [r.outcome for r in turn.race] == ['cancelled', 'won']
+    # Compared answers are waited for, but only until the deadline
+    _, _, turn = race(keep_others=True, deadline=2)
+    assert [r.outcome for r in turn.race] == ['finished', 'won']
+    assert turn.race_cost() == 4
+    assert turn.to_dict()['race'][0]['model'] == 'slow-model'
+    _, _, turn = race(keep_others=True, deadline=0.05)
+    assert [r.outcome for r in turn.race] == ['cancelled', 'won']